@@ -1,33 +1,63 @@
 import base64
+import json
+import multiprocessing
 import os
-from datetime import datetime
-from io import BytesIO
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 import pandas as pd
 import psycopg2
-from flask import Flask, request
-from matplotlib import pyplot as plt
+from flask import Flask, request, jsonify
+from prometheus_client import Counter, Histogram
+
+import charts
+import metrics
+import tracing
+from db import db_connection, pool_stats
+from render_cache import RenderCache
+from window import parse_window, window_conditions
 
 app = Flask(__name__)
+metrics.init_app(app)
+tracing.init_app(app)
+
+# pandas resample rule for each histogram granularity the analyzer can produce
+RESAMPLE_RULES = {"day": "D", "week": "W", "month": "M", "year": "A"}
+
+# Rendered charts are cached by content: in memory up to RENDER_CACHE_MAX_BYTES and, when
+# RENDER_CACHE_DIR is set, on disk up to RENDER_CACHE_DISK_MAX_BYTES (0 means unbounded)
+render_cache = RenderCache(
+    max_bytes=int(os.getenv("RENDER_CACHE_MAX_BYTES", str(64 * 1024 * 1024))),
+    directory=os.getenv("RENDER_CACHE_DIR") or None,
+    max_disk_bytes=int(os.getenv("RENDER_CACHE_DISK_MAX_BYTES", "0"))
+)
+
+# Processes that draw charts in parallel, 0 draws them inline in the request thread
+RENDER_WORKERS = int(os.getenv("RENDER_WORKERS", str(os.cpu_count() or 1)))
+
+# Output of /visualize (?format=): "png" embeds server-rendered images, "client" ships the chart
+# series to a page that draws them in the browser, "json" returns the series alone
+OUTPUT_FORMATS = ("png", "client", "json")
 
-# Database connection details from environment variables
-DB_HOST = os.getenv("DB_HOST", "localhost")
-DB_NAME = os.getenv("DB_NAME", "postgres")
-DB_USER = os.getenv("DB_USER", "postgres")
+# Pieces of the png page (?fragment=) the manager streams as the analyses come in: the page head,
+# the charts of one word-count group, and the most popular tweet, scatter plot and closing tags
+FRAGMENTS = ("head", "group", "summary")
 
+RENDER_LATENCY = Histogram("chart_render_duration_seconds", "Time spent drawing one chart", ["chart_type"])
+RENDER_CACHE_LOOKUPS = Counter("chart_render_cache_lookups_total", "Render cache lookups", ["result"])
 
-def connect_to_db():
-    conn = psycopg2.connect(
-        dbname=DB_NAME,
-        user=DB_USER,
-        host=DB_HOST
-    )
-    return conn
+_render_pool = None
+_render_pool_pid = None
+_render_pool_lock = threading.Lock()
 
 
-def get_tweet_from_db(tweet_id, cur):
-    # Function to retrieve a tweet from the database by ID
-    cur.execute("SELECT * FROM tweets WHERE unique_id = %s", (tweet_id,))
+def get_tweet_from_db(tweet_id, cur, window):
+    # Function to retrieve a tweet from the database by ID, looking only in the partitions of the
+    # request's time window
+    conditions, params = window_conditions(window)
+    cur.execute("SELECT * FROM tweets WHERE unique_id = %s" + conditions, [tweet_id] + params)
     tweet = cur.fetchone()
     return tweet
 
@@ -35,52 +65,86 @@ def get_tweet_from_db(tweet_id, cur):
 @app.route('/visualize', methods=['POST'])
 def visualize_analysis():
     data = request.json
+    granularity = request.args.get('granularity', "month")
+    output_format = request.args.get('format', "png")
+    if output_format not in OUTPUT_FORMATS:
+        return jsonify({"error": f"Unknown format '{output_format}'"}), 400
+    fragment = request.args.get('fragment')
+    if fragment is not None and fragment not in FRAGMENTS:
+        return jsonify({"error": f"Unknown fragment '{fragment}'"}), 400
+    try:
+        window = parse_window(request.args)
+    except ValueError as error:
+        return jsonify({"error": str(error)}), 400
+    if fragment == "head":
+        return PAGE_HEAD
     df = pd.DataFrame(data).T  # Transpose to get tokens as rows
     df['token'] = df.index
-    df['tweet_datetimes'] = df['tweet_datetimes'].apply(lambda x: [datetime.strptime(date, "%a, %d %b %Y %H:%M:%S %Z") for date in x])
-    most_popular_tweet = grab_most_popular_tweet(df)
-    bar_graphs = generate_bar_graphs(df)
-    line_charts = generate_line_charts(df)
-    scatter_plot = generate_scatter_plot(df)
+    if fragment == "group":
+        return generate_group_fragment(df, granularity)
+    if fragment == "summary":
+        return generate_summary_fragment(df, window)
+    most_popular_tweet = grab_most_popular_tweet(df, window)
+    bar_payloads = bar_graph_payloads(df)
+    line_payloads = line_chart_payloads(df, granularity)
+
+    if output_format != "png":
+        # The chart payloads are exactly the series the browser needs, no rendering on our side
+        chart_data = {
+            "most_popular_tweet": tweet_summary(most_popular_tweet),
+            "bar_graphs": bar_payloads,
+            "line_charts": line_payloads,
+            "scatter_plot": scatter_plot_payload(df)
+        }
+        if output_format == "json":
+            return jsonify(chart_data)
+        return generate_client_page(chart_data)
+
+    images = render_charts([("bar", payload) for payload in bar_payloads] +
+                           [("line", payload) for payload in line_payloads] +
+                           [("scatter", scatter_plot_payload(df))])
+    bar_graphs = images[:len(bar_payloads)]
+    line_charts = images[len(bar_payloads):-1]
+    scatter_plot = images[-1]
     return generate_web_page(most_popular_tweet, bar_graphs, line_charts, scatter_plot)
 
 
-def grab_most_popular_tweet(df):
+def grab_most_popular_tweet(df, window):
     try:
         most_popular_tweet = None
         
-        conn = connect_to_db()
-        cursor = conn.cursor()
-
-        tweets_cache = {}  # Cache to avoid fetching the same tweet multiple times
-        popular_tweets = {}
-
-        for index, row in df.iterrows():
-            for metric in ["likes", "shares"]:
-                # Determine the right column index based on the metric
-                tweet_id = row["tweet_with_highest_number_of_" + metric]
-
-                if tweet_id not in tweets_cache:
-                    tweet = get_tweet_from_db(tweet_id, cursor)
-                    if tweet:
-                        tweet_dict = {
-                            "unique_id": tweet[0],
-                            "author": tweet[1],
-                            "content": tweet[2],
-                            "country": tweet[3],
-                            "date_time": tweet[4],
-                            "id": tweet[5],
-                            "language": tweet[6],
-                            "latitude": tweet[7],
-                            "longitude": tweet[8],
-                            "number_of_likes": tweet[9],
-                            "number_of_shares": tweet[10]
-                        }
-                        tweets_cache[tweet_id] = tweet_dict  # Cache this tweet
-                        popular_tweets[row["token"] + " " + metric] = tweet_dict
-                else:
-                    # If the tweet is already in cache, use it
-                    popular_tweets[row["token"] + " " + metric] = tweets_cache[tweet_id]
+        with db_connection() as conn:
+            cursor = conn.cursor()
+
+            tweets_cache = {}  # Cache to avoid fetching the same tweet multiple times
+            popular_tweets = {}
+
+            for index, row in df.iterrows():
+                for metric in ["likes", "shares"]:
+                    # Determine the right column index based on the metric
+                    tweet_id = row["tweet_with_highest_number_of_" + metric]
+
+                    if tweet_id not in tweets_cache:
+                        tweet = get_tweet_from_db(tweet_id, cursor, window)
+                        if tweet:
+                            tweet_dict = {
+                                "unique_id": tweet[0],
+                                "author": tweet[1],
+                                "content": tweet[2],
+                                "country": tweet[3],
+                                "date_time": tweet[4],
+                                "id": tweet[5],
+                                "language": tweet[6],
+                                "latitude": tweet[7],
+                                "longitude": tweet[8],
+                                "number_of_likes": tweet[9],
+                                "number_of_shares": tweet[10]
+                            }
+                            tweets_cache[tweet_id] = tweet_dict  # Cache this tweet
+                            popular_tweets[row["token"] + " " + metric] = tweet_dict
+                    else:
+                        # If the tweet is already in cache, use it
+                        popular_tweets[row["token"] + " " + metric] = tweets_cache[tweet_id]
 
         highest_popularity_score = -1  # Sum of likes and shares
 
@@ -97,125 +161,155 @@ def grab_most_popular_tweet(df):
     
     except (Exception, psycopg2.DatabaseError) as error:
         print(error)
-    finally:
-        if conn is not None:
-            conn.close()
-    
-    
-def generate_bar_graphs(df):
-    images = []  # To store images
+
+
+def get_render_pool():
+    global _render_pool, _render_pool_pid
+    if RENDER_WORKERS <= 0:
+        return None
+    # One pool per worker process, created after any fork. The render processes come from a
+    # forkserver that imported matplotlib up front, and each draws a warm-up figure on start.
+    with _render_pool_lock:
+        if _render_pool is None or _render_pool_pid != os.getpid():
+            context = multiprocessing.get_context('forkserver')
+            context.set_forkserver_preload(['charts'])
+            _render_pool = ProcessPoolExecutor(max_workers=RENDER_WORKERS, mp_context=context,
+                                               initializer=charts.warm_up)
+            _render_pool_pid = os.getpid()
+        return _render_pool
+
+
+def discard_render_pool(pool):
+    global _render_pool
+    with _render_pool_lock:
+        if _render_pool is pool:
+            _render_pool = None
+    pool.shutdown(wait=False)
+
+
+def shutdown_render_pool():
+    # Stop this process's render processes, e.g. when a server worker shuts down
+    global _render_pool
+    with _render_pool_lock:
+        pool = _render_pool if _render_pool_pid == os.getpid() else None
+        _render_pool = None
+    if pool is not None:
+        pool.shutdown(wait=True)
+
+
+def render_charts(chart_list):
+    # Render (chart_type, payload) pairs and return their PNGs in the same order. Charts drawn
+    # before come from the cache; the rest are drawn concurrently by the render pool, so the
+    # request takes about as long as its slowest chart.
+    keys = [render_cache.key(chart_type, payload) for chart_type, payload in chart_list]
+    images = [render_cache.get(key) for key in keys]
+    missing = {}
+    for index, key in enumerate(keys):
+        RENDER_CACHE_LOOKUPS.labels("miss" if images[index] is None else "hit").inc()
+        if images[index] is None:
+            missing.setdefault(key, chart_list[index])
+
+    rendered = {}
+    pool = get_render_pool() if len(missing) > 1 else None
+    if pool is not None:
+        try:
+            futures = {key: pool.submit(charts.render_timed, *chart) for key, chart in missing.items()}
+            rendered = {key: future.result() for key, future in futures.items()}
+        except BrokenProcessPool as error:
+            # A render process died; start a fresh pool next time and draw this request inline
+            print(error)
+            discard_render_pool(pool)
+            rendered = {}
+    for key, chart in missing.items():
+        if key not in rendered:
+            rendered[key] = charts.render_timed(*chart)
+        png, seconds = rendered[key]
+        RENDER_LATENCY.labels(chart[0]).observe(seconds)
+        # Charts drawn by the pool only report how long drawing took, so the span ends when the
+        # result was collected
+        render_span = tracing.start_span("render_chart", attributes={"chart.type": chart[0], "chart.bytes": len(png)},
+                                         start_time=time.time() - seconds)
+        render_span.end()
+        render_cache.put(key, png)
+        rendered[key] = png
+
+    return [image if image is not None else rendered[key] for key, image in zip(keys, images)]
+
+
+def token_length_groups(df):
+    # Split the tokens into one chart per word count: (length, rows, whether the group holds
+    # exactly that many words or that many or more)
     token_lengths = df['token'].apply(lambda x: len(x.split()))
     unique_lengths = sorted(token_lengths.unique())
 
     if len(unique_lengths) == 1:  # If there's only one unique token length
         length = unique_lengths[0]
-        subset_df = df[token_lengths == length]
-        title = f'Total Tweets for Tokens with Exactly {length} Words'
-        fig, ax = plt.subplots()
-        subset_df.plot(kind='bar', x='token', y='total_number_of_tweets', title=title, ax=ax)
-        ax.set_xticklabels(ax.get_xticklabels(), rotation=0)  # Set labels rotation to horizontal
-        buf = BytesIO()
-        plt.savefig(buf, format='png')
-        plt.close(fig)
-        images.append(buf.getvalue())
-    else:
-        for i, length in enumerate(unique_lengths[:-1]):  # Exclude the last length initially
-            if i == len(unique_lengths) - 2:  # If this is the second to last length, include the last length as well
-                subset_df = df[token_lengths >= length]
-                title = f'Total Tweets for Tokens with {length} or More Words'
-            else:
-                subset_df = df[token_lengths == length]
-                title = f'Total Tweets for Tokens with Exactly {length} Words'
-            fig, ax = plt.subplots()
-            subset_df.plot(kind='bar', x='token', y='total_number_of_tweets', title=title, ax=ax)
-            ax.set_xticklabels(ax.get_xticklabels(), rotation=0)  # Set labels rotation to horizontal
-            buf = BytesIO()
-            plt.savefig(buf, format='png')
-            plt.close(fig)
-            images.append(buf.getvalue())
-
-    return images
-
-
-def generate_line_charts(df):
-    images = []  # To store images
-    df['token_length'] = df['token'].apply(lambda x: len(x.split()))
-    unique_lengths = sorted(df['token_length'].unique())
+        return [(length, df[token_lengths == length], True)]
 
-    if len(unique_lengths) == 1:  # If there's only one unique token length
-        length = unique_lengths[0]
-        tokens_df = df[df['token_length'] == length]
-        title = f'Tweets Over Time for Tokens with Exactly {length} Words'
-        fig, ax = plt.subplots()
+    groups = []
+    for i, length in enumerate(unique_lengths[:-1]):  # Exclude the last length initially
+        if i == len(unique_lengths) - 2:  # If this is the second to last length, include the last length as well
+            groups.append((length, df[token_lengths >= length], False))
+        else:
+            groups.append((length, df[token_lengths == length], True))
+    return groups
+
+
+def bar_graph_payloads(df):
+    payloads = []
+    for length, subset_df, exact in token_length_groups(df):
+        if exact:
+            title = f'Total Tweets for Tokens with Exactly {length} Words'
+        else:
+            title = f'Total Tweets for Tokens with {length} or More Words'
+        payloads.append({
+            "title": title,
+            "labels": list(subset_df['token']),
+            "values": [int(total) for total in subset_df['total_number_of_tweets']]
+        })
+    return payloads
+
+
+def histogram_series(histogram, granularity):
+    # The analyzer sends [[bucket_start, count], ...]; resampling fills the empty buckets with 0
+    counts = pd.Series([count for _, count in histogram],
+                       index=pd.to_datetime([bucket for bucket, _ in histogram]), dtype='int64')
+    return counts.resample(RESAMPLE_RULES.get(granularity, "M")).sum()
+
+
+def line_chart_payloads(df, granularity="month"):
+    payloads = []
+    for length, tokens_df, exact in token_length_groups(df):
+        if tokens_df.empty:
+            continue
+        if exact:
+            title = f'Tweets Over Time for Tokens with Exactly {length} Words'
+        else:
+            title = f'Tweets Over Time for Tokens with {length} or More Words'
+        series = []
         for token in tokens_df['token'].unique():
             token_df = tokens_df[tokens_df['token'] == token]
-            dates_df = pd.DataFrame(token_df['tweet_datetimes'].iloc[0], columns=['datetime'])
-            dates_df['count'] = 1
-            dates_df.set_index('datetime', inplace=True)
-            counts = dates_df.resample('M').sum()['count']
-            ax.plot(counts.index, counts.values, label=token)  # Plot with ax.plot for better control
-        ax.set_title(title)
-        ax.set_xlabel('Date')
-        ax.set_ylabel('Number of Tweets')
-        ax.legend()
-        buf = BytesIO()
-        plt.savefig(buf, format='png')
-        plt.close(fig)
-        images.append(buf.getvalue())
-    else:
-        for i, length in enumerate(unique_lengths[:-1]):  # Exclude the last length initially
-            if i == len(unique_lengths) - 2:  # Check if it's the second to last length
-                tokens_df = df[df['token_length'] >= length]
-                title = f'Tweets Over Time for Tokens with {length} or More Words'
-            else:
-                tokens_df = df[df['token_length'] == length]
-                title = f'Tweets Over Time for Tokens with Exactly {length} Words'
-
-            if not tokens_df.empty:
-                fig, ax = plt.subplots()
-                for token in tokens_df['token'].unique():
-                    token_df = tokens_df[tokens_df['token'] == token]
-                    dates_df = pd.DataFrame(token_df['tweet_datetimes'].iloc[0], columns=['datetime'])
-                    dates_df['count'] = 1
-                    dates_df.set_index('datetime', inplace=True)
-                    counts = dates_df.resample('M').sum()['count']
-
-                    ax.plot(counts.index, counts.values, label=token)  # Use ax.plot() for better control
-
-                ax.set_title(title)
-                ax.set_xlabel('Date')
-                ax.set_ylabel('Number of Tweets')
-                ax.legend()
-
-                buf = BytesIO()
-                plt.savefig(buf, format='png')
-                plt.close(fig)
-                images.append(buf.getvalue())
-
-    return images
-
-
-def generate_scatter_plot(df):
-    fig, ax = plt.subplots(figsize=(10, 6))
-    for index, row in df.iterrows():
-        ax.scatter(row['average_number_of_likes'], row['average_number_of_shares'], label=index)
-    ax.set_xlabel('Average Number of Likes')
-    ax.set_ylabel('Average Number of Shares')
-    ax.legend()
-    ax.set_title('Average Likes vs. Shares for Each Token')
-    buf = BytesIO()
-    plt.savefig(buf, format='png')
-    plt.close(fig)
-    return buf.getvalue()
-
+            counts = histogram_series(token_df['tweet_histogram'].iloc[0], granularity)
+            series.append({
+                "label": token,
+                "x": [timestamp.strftime('%Y-%m-%d') for timestamp in counts.index],
+                "y": [int(count) for count in counts.values]
+            })
+        payloads.append({"title": title, "series": series})
+    return payloads
+
+
+def scatter_plot_payload(df):
+    return {
+        "title": 'Average Likes vs. Shares for Each Token',
+        "points": [
+            {"label": index, "x": float(row['average_number_of_likes']), "y": float(row['average_number_of_shares'])}
+            for index, row in df.iterrows()
+        ]
+    }
 
-def generate_web_page(most_popular_tweet, bar_graphs, line_charts, scatter_plot):
-    bar_graphs_base64 = [convert_image_to_base64(img) for img in bar_graphs]
-    line_charts_base64 = [convert_image_to_base64(img) for img in line_charts]
-    scatter_plot_base64 = convert_image_to_base64(scatter_plot)
 
-    # Generate HTML content
-    html_content = """
+PAGE_HEAD = """
 <html>
 <head>
 <link rel="stylesheet" href="https://stackpath.bootstrapcdn.com/bootstrap/4.3.1/css/bootstrap.min.css" integrity="sha384-ggOyR0iXCbMQv3Xipma34MD+dH/1fQ784/j6cY/iJTQUOhcWr7x9JvoRxT2MZw1T" crossorigin="anonymous">
@@ -230,11 +324,30 @@ def generate_web_page(most_popular_tweet, bar_graphs, line_charts, scatter_plot)
 <h1>Visualization Analysis</h1>
 """
 
-    if most_popular_tweet:
-        html_content += f"<h2>Most Popular Tweet</h2>"
-        html_content += f"<p>Author: {most_popular_tweet['author']}</p>"
-        html_content += f"<p>Content: {most_popular_tweet['content']}</p>"
-        html_content += f"<p>Likes: {most_popular_tweet['number_of_likes']}, Shares: {most_popular_tweet['number_of_shares']}</p>"
+PAGE_TAIL = """
+<script src="https://code.jquery.com/jquery-3.3.1.slim.min.js" integrity="sha384-q8i/X+965DzO0rT7abK41JStQIAqVgRVzpbzo5smXKp4YfRvH+8abtTE1Pi6jizo" crossorigin="anonymous"></script>
+<script src="https://stackpath.bootstrapcdn.com/bootstrap/4.3.1/js/bootstrap.min.js" integrity="sha384-JjSmVgyd0p3pXB1rRibZUAYoIIy6OrQ6VrjIEaFf/nJGzIxFDsf4x0xIM+B07jRM" crossorigin="anonymous"></script>
+</body></html>"""
+
+
+def most_popular_tweet_html(most_popular_tweet):
+    if not most_popular_tweet:
+        return ""
+    html_content = f"<h2>Most Popular Tweet</h2>"
+    html_content += f"<p>Author: {most_popular_tweet['author']}</p>"
+    html_content += f"<p>Content: {most_popular_tweet['content']}</p>"
+    html_content += f"<p>Likes: {most_popular_tweet['number_of_likes']}, Shares: {most_popular_tweet['number_of_shares']}</p>"
+    return html_content
+
+
+def generate_web_page(most_popular_tweet, bar_graphs, line_charts, scatter_plot):
+    bar_graphs_base64 = [convert_image_to_base64(img) for img in bar_graphs]
+    line_charts_base64 = [convert_image_to_base64(img) for img in line_charts]
+    scatter_plot_base64 = convert_image_to_base64(scatter_plot)
+
+    # Generate HTML content
+    html_content = PAGE_HEAD
+    html_content += most_popular_tweet_html(most_popular_tweet)
 
     if bar_graphs_base64:
         html_content += """
@@ -289,24 +402,148 @@ def generate_web_page(most_popular_tweet, bar_graphs, line_charts, scatter_plot)
     html_content += "<h2>Scatter Plot</h2>"
     html_content += f'<img src="data:image/png;base64,{scatter_plot_base64}">'
 
-    html_content += """
-<script src="https://code.jquery.com/jquery-3.3.1.slim.min.js" integrity="sha384-q8i/X+965DzO0rT7abK41JStQIAqVgRVzpbzo5smXKp4YfRvH+8abtTE1Pi6jizo" crossorigin="anonymous"></script>
-<script src="https://stackpath.bootstrapcdn.com/bootstrap/4.3.1/js/bootstrap.min.js" integrity="sha384-JjSmVgyd0p3pXB1rRibZUAYoIIy6OrQ6VrjIEaFf/nJGzIxFDsf4x0xIM+B07jRM" crossorigin="anonymous"></script>
-"""
-    html_content += "</body></html>"
+    html_content += PAGE_TAIL
 
     return html_content
 
 
+def generate_group_fragment(df, granularity):
+    # Bar graph and line chart of a single word-count group, nothing when none of its tokens
+    # have tweets
+    if df.empty:
+        return ""
+    bar_payloads = bar_graph_payloads(df)
+    line_payloads = line_chart_payloads(df, granularity)
+    images = render_charts([("bar", payload) for payload in bar_payloads] +
+                           [("line", payload) for payload in line_payloads])
+
+    length = len(df['token'].iloc[0].split())
+    html_content = f"<h2>Tokens with {length} Word{'s' if length > 1 else ''}</h2>"
+    for img in images:
+        html_content += f'<img src="data:image/png;base64,{convert_image_to_base64(img)}" class="d-block w-100">'
+    return html_content
+
+
+def generate_summary_fragment(df, window):
+    # Everything that needs the analyses of all groups, then the end of the page
+    scatter_plot_base64 = convert_image_to_base64(render_charts([("scatter", scatter_plot_payload(df))])[0])
+    html_content = most_popular_tweet_html(grab_most_popular_tweet(df, window))
+    html_content += "<h2>Scatter Plot</h2>"
+    html_content += f'<img src="data:image/png;base64,{scatter_plot_base64}">'
+    html_content += PAGE_TAIL
+    return html_content
+
+
+def tweet_summary(tweet):
+    # The fields of the most popular tweet that the pages show
+    if not tweet:
+        return None
+    return {key: tweet[key] for key in ("unique_id", "author", "content", "date_time", "number_of_likes", "number_of_shares")}
+
+
+def generate_client_page(chart_data):
+    # Same layout as generate_web_page, but the charts are drawn by Chart.js from the embedded
+    # series, so the page size depends on the number of data points instead of image pixels
+    data_json = json.dumps(chart_data, default=str).replace("</", "<\\/")
+    return """
+<html>
+<head>
+<link rel="stylesheet" href="https://stackpath.bootstrapcdn.com/bootstrap/4.3.1/css/bootstrap.min.css" integrity="sha384-ggOyR0iXCbMQv3Xipma34MD+dH/1fQ784/j6cY/iJTQUOhcWr7x9JvoRxT2MZw1T" crossorigin="anonymous">
+<script src="https://cdn.jsdelivr.net/npm/chart.js@4.4.1/dist/chart.umd.min.js"></script>
+</head>
+<body>
+<h1>Visualization Analysis</h1>
+<div id="mostPopularTweet"></div>
+<div id="barGraphs"></div>
+<div id="lineCharts"></div>
+<h2>Scatter Plot</h2>
+<div style="max-width: 1000px"><canvas id="scatterPlot"></canvas></div>
+<script type="application/json" id="chartData">""" + data_json + """</script>
+<script>
+const chartData = JSON.parse(document.getElementById('chartData').textContent);
+
+function addCanvas(containerId) {
+    const wrapper = document.createElement('div');
+    wrapper.style.maxWidth = '800px';
+    const canvas = document.createElement('canvas');
+    wrapper.appendChild(canvas);
+    document.getElementById(containerId).appendChild(wrapper);
+    return canvas;
+}
+
+function titleOptions(text) {
+    return {plugins: {title: {display: true, text: text}}};
+}
+
+const tweet = chartData.most_popular_tweet;
+if (tweet) {
+    const container = document.getElementById('mostPopularTweet');
+    const heading = document.createElement('h2');
+    heading.textContent = 'Most Popular Tweet';
+    container.appendChild(heading);
+    for (const line of ['Author: ' + tweet.author, 'Content: ' + tweet.content,
+                        'Likes: ' + tweet.number_of_likes + ', Shares: ' + tweet.number_of_shares]) {
+        const paragraph = document.createElement('p');
+        paragraph.textContent = line;
+        container.appendChild(paragraph);
+    }
+}
+
+for (const bar of chartData.bar_graphs) {
+    new Chart(addCanvas('barGraphs'), {
+        type: 'bar',
+        data: {labels: bar.labels, datasets: [{label: 'total_number_of_tweets', data: bar.values}]},
+        options: titleOptions(bar.title)
+    });
+}
+
+for (const line of chartData.line_charts) {
+    // Series may cover different buckets, plot them against the union of all of them
+    const labels = [...new Set(line.series.flatMap(series => series.x))].sort();
+    const datasets = line.series.map(series => {
+        const counts = new Map(series.x.map((x, i) => [x, series.y[i]]));
+        return {label: series.label, data: labels.map(label => counts.has(label) ? counts.get(label) : null)};
+    });
+    const options = titleOptions(line.title);
+    options.scales = {x: {title: {display: true, text: 'Date'}}, y: {title: {display: true, text: 'Number of Tweets'}}};
+    new Chart(addCanvas('lineCharts'), {type: 'line', data: {labels: labels, datasets: datasets}, options: options});
+}
+
+const scatter = chartData.scatter_plot;
+const scatterOptions = titleOptions(scatter.title);
+scatterOptions.scales = {
+    x: {title: {display: true, text: 'Average Number of Likes'}},
+    y: {title: {display: true, text: 'Average Number of Shares'}}
+};
+new Chart(document.getElementById('scatterPlot'), {
+    type: 'scatter',
+    data: {datasets: scatter.points.map(point => ({label: point.label, data: [{x: point.x, y: point.y}]}))},
+    options: scatterOptions
+});
+</script>
+</body></html>
+"""
+
+
 def convert_image_to_base64(image_bytes):
     return base64.b64encode(image_bytes).decode('utf-8')
 
 
+@app.route('/render-cache-stats')
+def get_render_cache_stats():
+    return jsonify(render_cache.stats())
+
+
+@app.route('/pool-stats')
+def get_pool_stats():
+    return jsonify(pool_stats())
+
+
 @app.route('/')
 def hello():
     return "Hello, I am up and running, I am the visualizer"
 
 
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0', port=3005)
+    app.run(debug=os.getenv('FLASK_DEBUG') == '1', host='0.0.0.0', port=3005)
     
\ No newline at end of file
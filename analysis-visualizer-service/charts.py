@@ -0,0 +1,77 @@
+import time
+from io import BytesIO
+
+import matplotlib
+
+matplotlib.use('Agg')
+
+import pandas as pd  # noqa: E402
+from matplotlib import pyplot as plt  # noqa: E402
+
+# Figure renderers. Each one takes a plain JSON-able payload describing a single chart and
+# returns its PNG bytes, so a payload doubles as the chart's cache key.
+
+
+def figure_to_png(fig):
+    buf = BytesIO()
+    fig.savefig(buf, format='png')
+    plt.close(fig)
+    return buf.getvalue()
+
+
+def render_bar_graph(payload):
+    # payload: {"title", "labels": [token, ...], "values": [total_number_of_tweets, ...]}
+    subset_df = pd.DataFrame({'token': payload['labels'], 'total_number_of_tweets': payload['values']})
+    fig, ax = plt.subplots()
+    subset_df.plot(kind='bar', x='token', y='total_number_of_tweets', title=payload['title'], ax=ax)
+    ax.set_xticklabels(ax.get_xticklabels(), rotation=0)  # Set labels rotation to horizontal
+    return figure_to_png(fig)
+
+
+def render_line_chart(payload):
+    # payload: {"title", "series": [{"label", "x": [ISO date, ...], "y": [count, ...]}, ...]}
+    fig, ax = plt.subplots()
+    for series in payload['series']:
+        ax.plot(pd.to_datetime(series['x']), series['y'], label=series['label'])  # Use ax.plot() for better control
+    ax.set_title(payload['title'])
+    ax.set_xlabel('Date')
+    ax.set_ylabel('Number of Tweets')
+    ax.legend()
+    return figure_to_png(fig)
+
+
+def render_scatter_plot(payload):
+    # payload: {"title", "points": [{"label", "x": average likes, "y": average shares}, ...]}
+    fig, ax = plt.subplots(figsize=(10, 6))
+    for point in payload['points']:
+        ax.scatter(point['x'], point['y'], label=point['label'])
+    ax.set_xlabel('Average Number of Likes')
+    ax.set_ylabel('Average Number of Shares')
+    ax.legend()
+    ax.set_title(payload['title'])
+    return figure_to_png(fig)
+
+
+RENDERERS = {
+    "bar": render_bar_graph,
+    "line": render_line_chart,
+    "scatter": render_scatter_plot,
+}
+
+
+def render(chart_type, payload):
+    return RENDERERS[chart_type](payload)
+
+
+def render_timed(chart_type, payload):
+    # (png, seconds spent drawing it), timed where the drawing happens so that charts drawn by
+    # the render processes are measured too
+    start = time.perf_counter()
+    png = render(chart_type, payload)
+    return png, time.perf_counter() - start
+
+
+def warm_up():
+    # Draw a throwaway figure so a fresh render process has its fonts and font cache loaded
+    # before the first real chart arrives
+    render_line_chart({"title": "warm up", "series": [{"label": "warm up", "x": ["2021-01-01"], "y": [0]}]})
@@ -0,0 +1,176 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+from psycopg2 import extensions
+from psycopg2.pool import PoolError
+
+# Database connection details from environment variables
+DB_HOST = os.getenv("DB_HOST", "localhost")
+DB_NAME = os.getenv("DB_NAME", "postgres")
+DB_USER = os.getenv("DB_USER", "postgres")
+
+# Connections kept per worker process, seconds to wait for a free one before giving up,
+# and seconds a connection may sit idle before it is pinged again on checkout
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_HEALTH_CHECK_AFTER = float(os.getenv("DB_POOL_HEALTH_CHECK_AFTER", "30"))
+
+
+def connect_to_db():
+    conn = psycopg2.connect(
+        dbname=DB_NAME,
+        user=DB_USER,
+        host=DB_HOST
+    )
+    return conn
+
+
+class ConnectionPool:
+    # Thread-safe pool of at most `size` connections. Callers block (up to `timeout` seconds)
+    # when every connection is checked out instead of failing straight away.
+
+    def __init__(self, size, timeout, health_check_after):
+        self.size = size
+        self.timeout = timeout
+        self.health_check_after = health_check_after
+        self.pid = os.getpid()
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self._idle = []  # (connection, time it was returned)
+        self._stats = {
+            "in_use": 0,
+            "waits": 0,
+            "wait_seconds": 0.0,
+            "timeouts": 0,
+            "connects": 0,
+            "connect_seconds": 0.0,
+            "health_check_failures": 0,
+        }
+
+    def getconn(self):
+        if not self._slots.acquire(blocking=False):
+            start = time.monotonic()
+            acquired = self._slots.acquire(timeout=self.timeout)
+            with self._lock:
+                self._stats["waits"] += 1
+                self._stats["wait_seconds"] += time.monotonic() - start
+                if not acquired:
+                    self._stats["timeouts"] += 1
+            if not acquired:
+                raise PoolError(f"No database connection available after {self.timeout} seconds")
+        try:
+            conn = self._checkout()
+        except Exception:
+            self._slots.release()
+            raise
+        with self._lock:
+            self._stats["in_use"] += 1
+        return conn
+
+    def putconn(self, conn, discard=False):
+        try:
+            if not discard and not conn.closed:
+                # Hand the connection back clean: no open transaction, default session settings
+                if conn.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+                if conn.autocommit:
+                    conn.autocommit = False
+                with self._lock:
+                    self._idle.append((conn, time.monotonic()))
+            else:
+                conn.close()
+        except psycopg2.Error:
+            conn.close()
+        finally:
+            with self._lock:
+                self._stats["in_use"] -= 1
+            self._slots.release()
+
+    def closeall(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            conn.close()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats, size=self.size, idle=len(self._idle))
+        return stats
+
+    def _checkout(self):
+        while True:
+            with self._lock:
+                conn, returned_at = self._idle.pop() if self._idle else (None, None)
+            if conn is None:
+                return self._connect()
+            if conn.closed:
+                continue
+            if time.monotonic() - returned_at > self.health_check_after and not self._is_healthy(conn):
+                with self._lock:
+                    self._stats["health_check_failures"] += 1
+                conn.close()
+                continue
+            return conn
+
+    def _connect(self):
+        start = time.monotonic()
+        conn = connect_to_db()
+        with self._lock:
+            self._stats["connects"] += 1
+            self._stats["connect_seconds"] += time.monotonic() - start
+        return conn
+
+    @staticmethod
+    def _is_healthy(conn):
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1")
+            cursor.close()
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    global _pool
+    # Connections must never be shared across a fork, so every worker process builds its own
+    # pool on first use and reuses it for all of its requests
+    if _pool is None or _pool.pid != os.getpid():
+        with _pool_lock:
+            if _pool is None or _pool.pid != os.getpid():
+                _pool = ConnectionPool(DB_POOL_SIZE, DB_POOL_TIMEOUT, DB_POOL_HEALTH_CHECK_AFTER)
+    return _pool
+
+
+@contextmanager
+def db_connection():
+    # Borrow a pooled connection for the duration of the block. Connections that died
+    # mid-request are dropped instead of going back to the pool.
+    pool = get_pool()
+    conn = pool.getconn()
+    broken = False
+    try:
+        yield conn
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        broken = True
+        raise
+    finally:
+        pool.putconn(conn, discard=broken)
+
+
+def close_pool():
+    # Close this process's idle connections, e.g. when a server worker shuts down
+    if _pool is not None and _pool.pid == os.getpid():
+        _pool.closeall()
+
+
+def pool_stats():
+    return get_pool().stats()
@@ -0,0 +1,47 @@
+import os
+import shutil
+
+# Production server settings, used as `gunicorn --config gunicorn.conf.py app:app`. Each one can
+# be overridden from the environment.
+bind = f"0.0.0.0:{os.getenv('PORT', '3005')}"
+# Each worker also runs RENDER_WORKERS render processes, so keep the worker count low
+workers = int(os.getenv("GUNICORN_WORKERS", "2"))
+worker_class = "gthread"
+threads = int(os.getenv("GUNICORN_THREADS", "4"))
+# Seconds an idle keep-alive connection stays open, a silent worker lives, and in-flight requests
+# get to finish on shutdown (SIGTERM)
+keepalive = int(os.getenv("GUNICORN_KEEPALIVE", "5"))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "120"))
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", "30"))
+accesslog = "-"
+
+# Import pandas and matplotlib once in the master; workers share those pages after the fork
+preload_app = True
+
+
+def when_ready(server):
+    # Runs in the master before any worker is forked, so they all start with a built font cache
+    import charts
+    charts.warm_up()
+
+
+def worker_exit(server, worker):
+    # Stop the worker's render processes and close its pooled database connections
+    from app import shutdown_render_pool
+    from db import close_pool
+    shutdown_render_pool()
+    close_pool()
+
+
+def on_starting(server):
+    # Workers write their metrics to PROMETHEUS_MULTIPROC_DIR; start from an empty one so the
+    # samples of a previous run aren't added to this one's
+    directory = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+    if directory:
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory)
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,66 @@
+import os
+import time
+from contextlib import contextmanager
+
+from flask import Response, g, request
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Histogram, generate_latest, multiprocess
+
+import tracing
+
+# Under gunicorn every worker is a separate process. With PROMETHEUS_MULTIPROC_DIR set, each one
+# writes its samples to that directory and /metrics adds them up across the workers.
+MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds", "Time spent serving HTTP requests (until the first byte for streamed ones)",
+    ["method", "route", "status"]
+)
+DB_QUERY_LATENCY = Histogram(
+    "db_query_duration_seconds", "Time spent running database queries, including fetching their rows",
+    ["query"]
+)
+DB_QUERY_ROWS = Histogram(
+    "db_query_rows", "Rows returned by database queries",
+    ["query"], buckets=(0, 1, 10, 100, 1000, 10000, 100000, 1000000, float("inf"))
+)
+
+
+def init_app(app):
+    # Time every request by route and serve the metrics at /metrics
+
+    @app.before_request
+    def start_request_timer():
+        g.request_start = time.perf_counter()
+
+    @app.after_request
+    def record_request_latency(response):
+        start = g.pop("request_start", None)
+        if start is not None:
+            # The route pattern, not the URL, so path parameters don't explode the label values
+            route = request.url_rule.rule if request.url_rule else "unmatched"
+            REQUEST_LATENCY.labels(request.method, route, response.status_code).observe(time.perf_counter() - start)
+        return response
+
+    @app.route('/metrics')
+    def get_metrics():
+        if MULTIPROC_DIR:
+            registry = CollectorRegistry()
+            multiprocess.MultiProcessCollector(registry)
+        else:
+            registry = REGISTRY
+        return Response(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
+
+
+@contextmanager
+def db_query(name):
+    # Time the block as one database query, in the metrics and as a trace span. The block stores
+    # the number of rows it got back in the yielded dict's "rows".
+    result = {"rows": 0}
+    start = time.perf_counter()
+    with tracing.span(f"db {name}", **{"db.query": name}) as query_span:
+        try:
+            yield result
+        finally:
+            DB_QUERY_LATENCY.labels(name).observe(time.perf_counter() - start)
+            DB_QUERY_ROWS.labels(name).observe(result["rows"])
+            query_span.set_attribute("db.rows", result["rows"])
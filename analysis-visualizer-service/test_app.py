@@ -0,0 +1,8 @@
+from app import app
+
+
+def test_group_fragment_of_a_window_without_tweets():
+    # The analyzer leaves out tokens without tweets in the window, so a whole group can be empty
+    response = app.test_client().post("/visualize?fragment=group&since=2030-01-01&until=2030-02-01", json={})
+    assert response.status_code == 200
+    assert response.get_data() == b""
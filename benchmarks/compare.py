@@ -0,0 +1,80 @@
+import argparse
+import json
+import sys
+
+# Compares two run_benchmark.py result files target by target and level by level. Exits with
+# status 1 when a throughput or latency figure regressed by more than --threshold percent.
+
+METRICS = (
+    # (name, how to read it from a run, True when higher is better)
+    ("req/s", lambda run: run["throughput_rps"], True),
+    ("p50 ms", lambda run: run["latency_ms"]["p50"], False),
+    ("p95 ms", lambda run: run["latency_ms"]["p95"], False),
+    ("p99 ms", lambda run: run["latency_ms"]["p99"], False),
+)
+
+
+def load_runs(path):
+    with open(path) as f:
+        results = json.load(f)
+    return results, {(run["target"], run["concurrency"]): run for run in results["runs"]}
+
+
+def change(base, new):
+    if base in (None, 0) or new is None:
+        return None
+    return (new - base) / base * 100
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare two benchmark result files")
+    parser.add_argument("base")
+    parser.add_argument("new")
+    parser.add_argument("--threshold", type=float, default=10.0,
+                        help="percent change counted as a regression (default 10)")
+    args = parser.parse_args()
+
+    base_results, base_runs = load_runs(args.base)
+    new_results, new_runs = load_runs(args.new)
+    print(f"base: {base_results.get('label') or args.base} ({base_results.get('commit')})")
+    print(f"new:  {new_results.get('label') or args.new} ({new_results.get('commit')})")
+    print()
+    print(f"{'target':>9} {'conc':>4}  " + "  ".join(f"{name:>26}" for name, _, _ in METRICS))
+
+    regressions = []
+    for key in sorted(set(base_runs) & set(new_runs)):
+        base_run, new_run = base_runs[key], new_runs[key]
+        cells = []
+        for name, read, higher_is_better in METRICS:
+            base_value, new_value = read(base_run), read(new_run)
+            percent = change(base_value, new_value)
+            if percent is None:
+                cells.append(f"{'n/a':>26}")
+                continue
+            cells.append(f"{base_value:>10.2f} -> {new_value:>8.2f} {percent:+5.0f}%")
+            worse = -percent if higher_is_better else percent
+            if worse > args.threshold:
+                regressions.append(f"{key[0]} x{key[1]} {name}: {percent:+.1f}%")
+        print(f"{key[0]:>9} {key[1]:>4}  " + "  ".join(cells))
+
+    base_rss, new_rss = base_results.get("peak_rss_bytes") or {}, new_results.get("peak_rss_bytes") or {}
+    if base_rss or new_rss:
+        print()
+        for service in sorted(set(base_rss) | set(new_rss)):
+            base_value, new_value = base_rss.get(service), new_rss.get(service)
+            percent = change(base_value, new_value)
+            print(f"{service:>30}  peak RSS {(base_value or 0) / 2 ** 20:>8.1f} MiB -> {(new_value or 0) / 2 ** 20:>8.1f} MiB"
+                  + (f" {percent:+5.0f}%" if percent is not None else ""))
+
+    missing = sorted(set(base_runs) ^ set(new_runs))
+    if missing:
+        print(f"\nOnly in one of the files: {', '.join(f'{target} x{level}' for target, level in missing)}")
+    if regressions:
+        print("\nRegressions beyond {:.0f}%:".format(args.threshold))
+        for regression in regressions:
+            print(f"  {regression}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+import argparse
+import bisect
+import csv
+import itertools
+import json
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+# Writes a synthetic tweets CSV in the layout database-feeding-service ingests (same columns as
+# tweets.csv, dates as DD/MM/YYYY HH:MM), streaming row by row so 10M-row corpora need no more
+# memory than 10k-row ones. Words follow a Zipf distribution over a generated vocabulary, like
+# natural language: a few words are in a large share of the tweets and most words are rare.
+# The vocabulary, most frequent word first, is written next to the CSV for run_benchmark.py.
+
+SYLLABLES = ["ba", "ko", "ri", "tu", "me", "sa", "no", "li", "da", "ve", "chi", "po", "ga", "ru", "xe", "fo",
+             "mi", "ta", "ze", "lo", "ka", "ni", "su", "pe", "ho", "wa", "de", "gu", "yo", "bi"]
+COUNTRIES = ["US", "GB", "FR", "DE", "IL", "IN", "BR", "JP", "CA", "ES"]
+LANGUAGES = ["en", "en", "en", "fr", "de", "es", "he", "ja", "pt"]
+
+
+def build_vocabulary(size, rng):
+    # Distinct pronounceable words; shorter words get the higher ranks, as in real text
+    words = []
+    seen = set()
+    for length in itertools.count(2):
+        candidates = ["".join(parts) for parts in itertools.product(SYLLABLES, repeat=length)]
+        rng.shuffle(candidates)
+        for word in candidates:
+            if word not in seen:
+                seen.add(word)
+                words.append(word)
+                if len(words) == size:
+                    return words
+
+
+def zipf_cumulative_weights(size, exponent):
+    total = 0.0
+    weights = []
+    for rank in range(1, size + 1):
+        total += 1.0 / rank ** exponent
+        weights.append(total)
+    return weights
+
+
+def generate_rows(rows, vocabulary, exponent, seed, none_author_ratio):
+    rng = random.Random(seed)
+    cumulative = zipf_cumulative_weights(len(vocabulary), exponent)
+    total_weight = cumulative[-1]
+    start = datetime(2019, 1, 1)
+    span_minutes = 5 * 365 * 24 * 60
+    for number in range(rows):
+        # Word draws by inverse transform sampling over the cumulative Zipf weights
+        words = [vocabulary[bisect.bisect_left(cumulative, rng.random() * total_weight)]
+                 for _ in range(rng.randint(4, 20))]
+        author = 'None' if rng.random() < none_author_ratio else f"user_{rng.randint(1, max(rows // 20, 10))}"
+        date_time = start + timedelta(minutes=rng.randrange(span_minutes))
+        # Engagement is heavy-tailed too: most tweets get little, a few get a lot
+        likes = int(rng.paretovariate(1.2)) - 1
+        shares = int(likes * rng.random() * 0.3)
+        yield [
+            author,
+            " ".join(words),
+            rng.choice(COUNTRIES) if rng.random() < 0.3 else "",
+            date_time.strftime('%d/%m/%Y %H:%M'),
+            f"bench-{seed}-{number}",
+            rng.choice(LANGUAGES),
+            "",
+            "",
+            likes,
+            shares,
+        ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic tweets corpus for the benchmarks")
+    parser.add_argument("--rows", type=int, default=10000, help="number of tweets (default 10000)")
+    parser.add_argument("--vocabulary", type=int, default=50000, help="distinct words (default 50000)")
+    parser.add_argument("--zipf", type=float, default=1.1, help="Zipf exponent of word frequencies (default 1.1)")
+    parser.add_argument("--none-author-ratio", type=float, default=0.001,
+                        help="share of tweets with author 'None', the fallback results (default 0.001)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", required=True, help="CSV to write, e.g. ingest/bench-1m.csv")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    vocabulary = build_vocabulary(args.vocabulary, rng)
+
+    start = time.monotonic()
+    # Written under a temporary name and renamed, the ingest watcher must never see half a file
+    tmp_path = args.out + ".tmp"
+    with open(tmp_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(["author", "content", "country", "date_time", "id", "language", "latitude", "longitude",
+                         "number_of_likes", "number_of_shares"])
+        for number, row in enumerate(generate_rows(args.rows, vocabulary, args.zipf, args.seed,
+                                                   args.none_author_ratio), 1):
+            writer.writerow(row)
+            if number % 1000000 == 0:
+                print(f"{number} rows written ({number / (time.monotonic() - start):.0f} rows/sec)", file=sys.stderr)
+    with open(args.out + ".vocab.json", 'w') as f:
+        json.dump({"rows": args.rows, "zipf": args.zipf, "seed": args.seed, "words": vocabulary}, f)
+    os.replace(tmp_path, args.out)
+    print(f"Wrote {args.rows} rows to {args.out} in {time.monotonic() - start:.1f}s", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,353 @@
+import argparse
+import http.client
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import threading
+import time
+from urllib.parse import urlsplit
+
+# Drives the pipeline endpoints at controlled concurrency and writes throughput, latency
+# percentiles and per-service peak RSS as JSON. Only needs the standard library and a Linux
+# /proc for the memory figures. Typical run, with the services up on localhost:
+#
+#   python benchmarks/generate_corpus.py --rows 1000000 --out ingest/bench-1m.csv
+#   python benchmarks/run_benchmark.py --corpus ingest/bench-1m.csv --concurrency 1,4,16 \
+#       --pid token-finding-service=1234 --out benchmarks/results/1m.json
+
+DEFAULT_URLS = {
+    "feeding": "http://localhost:3999",
+    "find": "http://localhost:3003/find-tweets",
+    "analyze": "http://localhost:3004/analyze-tweets",
+    "visualize": "http://localhost:3005/visualize",
+    "handle": "http://localhost:3010/handle-request",
+}
+TARGETS = ("find", "analyze", "visualize", "handle")
+
+
+class Client:
+    # One keep-alive connection per load thread, reopened after errors
+    def __init__(self, url, timeout):
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.path = parts.path or "/"
+        self.timeout = timeout
+        self.conn = None
+
+    def request(self, method, body=None, query="", headers=None):
+        if self.conn is None:
+            self.conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        all_headers = {"Content-Type": "application/json"}
+        all_headers.update(headers or {})
+        try:
+            self.conn.request(method, self.path + query, body=body, headers=all_headers)
+            response = self.conn.getresponse()
+            payload = response.read()
+            return response.status, payload
+        except (OSError, http.client.HTTPException):
+            self.conn.close()
+            self.conn = None
+            raise
+
+
+def get_json(url, timeout=30):
+    client = Client(url, timeout)
+    status, payload = client.request("GET")
+    return status, json.loads(payload) if payload else None
+
+
+def post_json(url, body, query="", timeout=600):
+    client = Client(url, timeout)
+    status, payload = client.request("POST", json.dumps(body).encode(), query)
+    return status, payload
+
+
+def load_corpus(feeding_url, corpus, poll_seconds):
+    # POST /ingest for the corpus file, then follow its checkpoint until it is fully loaded
+    name = os.path.basename(corpus)
+    start = time.monotonic()
+    status, payload = post_json(feeding_url + "/ingest", {"file": name})
+    if status != 202:
+        sys.exit(f"/ingest answered {status}: {payload[:200]!r}")
+    file_path = json.loads(payload)["file"]
+    while True:
+        time.sleep(poll_seconds)
+        status, checkpoints = get_json(feeding_url + "/ingest")
+        checkpoint = next((c for c in checkpoints or [] if c["file_path"] == file_path), None)
+        if checkpoint:
+            print(f"  {checkpoint['rows_read']} rows read, {checkpoint['rows_inserted']} inserted", file=sys.stderr)
+            if checkpoint["completed"]:
+                elapsed = time.monotonic() - start
+                return {"file": file_path, "rows_read": checkpoint["rows_read"],
+                        "rows_inserted": checkpoint["rows_inserted"], "seconds": round(elapsed, 3),
+                        "rows_per_sec": round(checkpoint["rows_read"] / max(elapsed, 1e-9))}
+
+
+def build_queries(words, count, tokens_per_query, seed):
+    # Token lists mixing frequent, mid-frequency and rare words, the way real searches do
+    rng = random.Random(seed)
+    bands = [words[:100], words[100:5000] or words, words[5000:] or words]
+    queries = []
+    for _ in range(count):
+        queries.append([rng.choice(bands[i % len(bands)]) for i in range(tokens_per_query)])
+    return queries
+
+
+def percentile(sorted_values, p):
+    # Nearest-rank percentile
+    if not sorted_values:
+        return None
+    rank = max(1, -(-len(sorted_values) * p // 100))
+    return sorted_values[int(rank) - 1]
+
+
+def process_tree(pid):
+    # The pid and all of its descendants (gunicorn workers, render processes, ...)
+    children = {}
+    for entry in os.listdir("/proc"):
+        if entry.isdigit():
+            try:
+                with open(f"/proc/{entry}/stat") as f:
+                    ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+            children.setdefault(ppid, []).append(int(entry))
+    tree, pending = [], [pid]
+    while pending:
+        current = pending.pop()
+        tree.append(current)
+        pending.extend(children.get(current, []))
+    return tree
+
+
+def memory_of(pids, field):
+    total = 0
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/status") as f:
+                for line in f:
+                    if line.startswith(field + ":"):
+                        total += int(line.split()[1]) * 1024
+        except OSError:
+            pass
+    return total
+
+
+class RssSampler:
+    # Samples the summed RSS of each service's process tree; peak() is the highest sum since reset()
+    def __init__(self, service_pids, interval):
+        self.service_pids = service_pids
+        self.interval = interval
+        self.peaks = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        if self.service_pids:
+            self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def sample(self):
+        for service, pid in self.service_pids.items():
+            rss = memory_of(process_tree(pid), "VmRSS")
+            with self.lock:
+                self.peaks[service] = max(self.peaks.get(service, 0), rss)
+
+    def reset(self):
+        with self.lock:
+            self.peaks = {}
+
+    def peak(self):
+        self.sample()
+        with self.lock:
+            return dict(self.peaks)
+
+    def high_water_marks(self):
+        # Kernel-tracked per-process peaks (VmHWM), summed: an upper bound for the whole run
+        return {service: memory_of(process_tree(pid), "VmHWM") for service, pid in self.service_pids.items()}
+
+    def stop(self):
+        self.stopped.set()
+
+
+def run_level(target, url, bodies, concurrency, requests, duration, timeout, headers, query):
+    # `concurrency` threads, each on its own connection, send requests back to back until
+    # `requests` were sent or `duration` seconds passed
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    counter = iter(range(requests)) if requests else None
+    deadline = time.monotonic() + duration if duration else None
+
+    def worker(thread_number):
+        client = Client(url, timeout)
+        rng = random.Random(thread_number)
+        while True:
+            if deadline is not None and time.monotonic() >= deadline:
+                return
+            if counter is not None:
+                with lock:
+                    if next(counter, None) is None:
+                        return
+            body = rng.choice(bodies)
+            start = time.perf_counter()
+            try:
+                status, _ = client.request("POST", body, query, headers)
+            except (OSError, http.client.HTTPException) as e:
+                status = repr(e)
+            elapsed = time.perf_counter() - start
+            with lock:
+                if status == 200:
+                    latencies.append(elapsed)
+                else:
+                    errors.append(status)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    start = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - start
+
+    latencies.sort()
+    return {
+        "target": target,
+        "concurrency": concurrency,
+        "requests": len(latencies) + len(errors),
+        "errors": len(errors),
+        "error_samples": [str(error) for error in errors[:5]],
+        "seconds": round(elapsed, 3),
+        "throughput_rps": round(len(latencies) / max(elapsed, 1e-9), 3),
+        "latency_ms": {
+            "p50": round(percentile(latencies, 50) * 1000, 3) if latencies else None,
+            "p95": round(percentile(latencies, 95) * 1000, 3) if latencies else None,
+            "p99": round(percentile(latencies, 99) * 1000, 3) if latencies else None,
+            "mean": round(sum(latencies) / len(latencies) * 1000, 3) if latencies else None,
+            "max": round(latencies[-1] * 1000, 3) if latencies else None,
+        },
+    }
+
+
+def prepare_bodies(queries, urls, granularity, engine):
+    # Every stage gets realistic input: its upstream stage's real output for the same queries
+    bodies = {"find": [], "analyze": [], "visualize": [], "handle": []}
+    for tokens in queries:
+        find_body = {"tokens": tokens, "engine": engine} if engine else {"tokens": tokens}
+        bodies["find"].append(json.dumps(find_body).encode())
+        bodies["handle"].append(json.dumps(dict(find_body, granularity=granularity)).encode())
+        status, found = post_json(urls["find"], find_body)
+        if status != 200:
+            sys.exit(f"/find-tweets answered {status} while preparing: {found[:200]!r}")
+        bodies["analyze"].append(found)
+        status, analyzed = post_json(urls["analyze"], json.loads(found), f"?granularity={granularity}")
+        if status != 200:
+            sys.exit(f"/analyze-tweets answered {status} while preparing: {analyzed[:200]!r}")
+        bodies["visualize"].append(analyzed)
+    return bodies
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the tweet analyzer pipeline")
+    parser.add_argument("--corpus", help="corpus CSV from generate_corpus.py, inside the feeding service's ingest directory")
+    parser.add_argument("--skip-load", action="store_true", help="the corpus is already loaded")
+    parser.add_argument("--targets", default=",".join(TARGETS), help=f"comma separated subset of {','.join(TARGETS)}")
+    parser.add_argument("--concurrency", default="1,4,16", help="comma separated concurrency levels (default 1,4,16)")
+    parser.add_argument("--requests", type=int, default=200, help="requests per target and level (default 200)")
+    parser.add_argument("--duration", type=float, default=0, help="seconds per target and level, instead of --requests")
+    parser.add_argument("--queries", type=int, default=50, help="distinct token lists to cycle through (default 50)")
+    parser.add_argument("--tokens-per-query", type=int, default=3)
+    parser.add_argument("--granularity", default="month")
+    parser.add_argument("--engine", help="token-finding engine (index, ilike or fts); the service default otherwise")
+    parser.add_argument("--use-result-cache", action="store_true",
+                        help="let /handle-request answer from the manager's result cache (bypassed by default)")
+    parser.add_argument("--timeout", type=float, default=300, help="seconds before a request counts as failed")
+    parser.add_argument("--pid", action="append", default=[], metavar="SERVICE=PID",
+                        help="main process of a service to track the RSS of (with its children); repeatable. "
+                             "For containers: docker inspect -f '{{.State.Pid}}' <container>")
+    parser.add_argument("--rss-interval", type=float, default=0.5)
+    parser.add_argument("--seed", type=int, default=0)
+    for name, url in DEFAULT_URLS.items():
+        parser.add_argument(f"--{name}-url", default=url)
+    parser.add_argument("--label", default="", help="free-form name for this run, e.g. the branch")
+    parser.add_argument("--out", required=True, help="JSON results file")
+    args = parser.parse_args()
+
+    urls = {name: getattr(args, f"{name}_url") for name in DEFAULT_URLS}
+    targets = [target for target in args.targets.split(",") if target]
+    for target in targets:
+        if target not in TARGETS:
+            parser.error(f"unknown target {target}")
+    levels = [int(level) for level in args.concurrency.split(",")]
+    service_pids = {}
+    for item in args.pid:
+        service, _, pid = item.partition("=")
+        service_pids[service] = int(pid)
+
+    results = {
+        "label": args.label,
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "commit": git_commit(),
+        "host": {"platform": platform.platform(), "cpus": os.cpu_count(), "python": platform.python_version()},
+        "settings": {key: value for key, value in vars(args).items() if key not in ("pid", "out")},
+        "load": None,
+        "runs": [],
+    }
+
+    words = []
+    if args.corpus:
+        with open(args.corpus + ".vocab.json") as f:
+            vocabulary = json.load(f)
+        words = vocabulary["words"]
+        results["corpus"] = {"file": args.corpus, "rows": vocabulary["rows"], "zipf": vocabulary["zipf"]}
+        if not args.skip_load:
+            print(f"Loading {args.corpus}", file=sys.stderr)
+            results["load"] = load_corpus(urls["feeding"], args.corpus, poll_seconds=2)
+    if not words:
+        sys.exit("--corpus is needed to pick the query tokens")
+
+    queries = build_queries(words, args.queries, args.tokens_per_query, args.seed)
+    print("Preparing request bodies", file=sys.stderr)
+    bodies = prepare_bodies(queries, urls, args.granularity, args.engine)
+
+    sampler = RssSampler(service_pids, args.rss_interval)
+    sampler.start()
+    for target in targets:
+        headers = {} if args.use_result_cache or target != "handle" else {"X-Cache-Bypass": "1"}
+        query = f"?granularity={args.granularity}" if target in ("analyze", "visualize") else ""
+        for level in levels:
+            sampler.reset()
+            run = run_level(target, urls[target], bodies[target], level, 0 if args.duration else args.requests,
+                            args.duration, args.timeout, headers, query)
+            run["peak_rss_bytes"] = sampler.peak()
+            results["runs"].append(run)
+            latency = run["latency_ms"]
+            print(f"{target:>9} x{level:<3} {run['throughput_rps']:>9.2f} req/s  p50 {latency['p50']} ms  "
+                  f"p95 {latency['p95']} ms  p99 {latency['p99']} ms  errors {run['errors']}", file=sys.stderr)
+    results["peak_rss_bytes"] = sampler.high_water_marks()
+    sampler.stop()
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+    with open(args.out, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.out}", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,44 +1,119 @@
 import os
-from datetime import datetime
+import queue
+import threading
+import time
+from datetime import date, datetime
+from io import StringIO
 import psycopg2
 import csv
 from flask import Flask, request, jsonify
-import tweepy
+from psycopg2.extras import execute_values
+
+import metrics
+import tracing
+from db import db_connection, pool_stats
+from metrics import db_query
+from tweet_sources import get_tweet_source
 
 app = Flask(__name__)
+metrics.init_app(app)
+tracing.init_app(app)
 
-# Database connection details from environment variables
-DB_HOST = os.getenv("DB_HOST", "localhost")
-DB_NAME = os.getenv("DB_NAME", "postgres")
-DB_USER = os.getenv("DB_USER", "postgres")
+# Where /grab-tweets fetches from ("twitter" or "fake"), how many pages of what size, and how many
+# fetched pages may wait for the database writer before fetching blocks
+TWEET_SOURCE = os.getenv("TWEET_SOURCE", "twitter")
+GRAB_MAX_PAGES = int(os.getenv("GRAB_MAX_PAGES", "10"))
+GRAB_PAGE_SIZE = int(os.getenv("GRAB_PAGE_SIZE", "100"))
+GRAB_QUEUE_SIZE = int(os.getenv("GRAB_QUEUE_SIZE", "4"))
 
-api_key = os.getenv('TWITTER_API_KEY')
-api_secret_key = os.getenv('TWITTER_API_SECRET_KEY')
-access_token = os.getenv('TWITTER_ACCESS_TOKEN')
-access_token_secret = os.getenv('TWITTER_ACCESS_TOKEN_SECRET')
+# Rows sent per COPY statement; memory stays bounded by one chunk whatever the file size
+COPY_CHUNK_ROWS = int(os.getenv("COPY_CHUNK_ROWS", "50000"))
 
+# New CSV drops are picked up from this directory, every INGEST_POLL_SECONDS (0 disables the watcher)
+INGEST_DIR = os.getenv("INGEST_DIR", "ingest")
+INGEST_POLL_SECONDS = float(os.getenv("INGEST_POLL_SECONDS", "60"))
 
-def connect_to_db():
-    conn = psycopg2.connect(
-        dbname=DB_NAME,
-        user=DB_USER,
-        host=DB_HOST
-    )
-    return conn
+# First key of the advisory locks that keep two workers from ingesting the same file at once
+INGEST_LOCK_KEY = 3999
+# Advisory lock held while the search indexes are built, so only one worker builds them
+MIGRATION_LOCK_KEY = 4000
+# Advisory lock held while rollup tokens are selected and backfilled
+ROLLUP_LOCK_KEY = 4001
+# Advisory lock held while tables and partitions are created, so workers don't race each other
+PARTITION_LOCK_KEY = 4002
+# Transaction advisory lock taken before any row goes into tweets, so the rollup increments of
+# merges and the recomputes of upserts apply one transaction at a time, each seeing the last
+ROLLUP_MAINTENANCE_LOCK_KEY = 4003
 
+# Tokens whose per-month statistics are kept precomputed in token_rollups: the comma separated
+# ROLLUP_TOKENS plus, with ROLLUP_TOP_WORDS > 0, that many of the words found in the most tweets.
+# More can be added at runtime through POST /rollup-tokens.
+ROLLUP_TOKENS = os.getenv("ROLLUP_TOKENS", "").split(",")
+ROLLUP_TOP_WORDS = int(os.getenv("ROLLUP_TOP_WORDS", "0"))
 
-def connect_to_api():
-    auth = tweepy.OAuthHandler(api_key, api_secret_key)
-    auth.set_access_token(access_token, access_token_secret)
-    api = tweepy.API(auth)
-    return api
+# Data versions whose changes are kept in tweet_changes; consumers further behind re-read the table
+CHANGE_LOG_VERSIONS = int(os.getenv("CHANGE_LOG_VERSIONS", "10000"))
 
+# Indexes behind token-finding's "fts" engine (whole words, through a tsvector expression that
+# must match the one it queries) and, with pg_trgm available and SEARCH_TRGM_INDEX=1, its "ilike"
+# engine (substrings). Expression indexes need no new column, so existing tables are not
+# rewritten, and Postgres keeps them current on every insert.
+SEARCH_INDEXES = (
+    ("tweets_content_fts_idx", "USING GIN (to_tsvector('simple', coalesce(content, '')))"),
+    ("tweets_content_trgm_idx", "USING GIN (content gin_trgm_ops)"),
+)
+SEARCH_TRGM_INDEX = os.getenv("SEARCH_TRGM_INDEX", "1") == "1"
 
-def create_tables():
-    commands = (
-        """
+# Chunks are copied into a session-local staging table first so duplicates can be skipped on insert
+STAGING_SQL = """
+CREATE TEMP TABLE IF NOT EXISTS tweets_staging (
+    author VARCHAR(255),
+    content TEXT,
+    country VARCHAR(255),
+    date_time TIMESTAMP WITHOUT TIME ZONE,
+    id TEXT,
+    language VARCHAR(50),
+    latitude NUMERIC(10, 8),
+    longitude NUMERIC(11, 8),
+    number_of_likes INT,
+    number_of_shares INT
+) ON COMMIT DELETE ROWS
+"""
+
+COPY_SQL = """
+COPY tweets_staging(author, content, country, date_time, id, language, latitude, longitude, number_of_likes, number_of_shares)
+FROM STDIN WITH (FORMAT csv)
+"""
+
+# A rollup token matches the tweets token-finding's "ilike" lookup returns for it: content
+# containing it, case insensitively (tokens are stored in lower case), leaving out the 'None' fallback tweets. Tweets without a
+# date are rolled up under ROLLUP_NO_DATE.
+ROLLUP_NO_DATE = "0001-01-01"
+ROLLUP_MATCH = "position(t.token IN lower(w.content)) > 0 AND w.author <> 'None'"
+ROLLUP_MONTH = f"COALESCE(date_trunc('month', w.date_time)::date, DATE '{ROLLUP_NO_DATE}')"
+# Per (token, month) statistics of the matching rows of "w", for the tokens of "t". Ties on the
+# maximum go to the lowest unique_id, like the analyzer's own argmax.
+ROLLUP_SELECT = f"""
+SELECT t.token, {ROLLUP_MONTH},
+       count(*),
+       sum(COALESCE(w.number_of_likes, 0)),
+       sum(COALESCE(w.number_of_shares, 0)),
+       max(w.number_of_likes),
+       (array_agg(w.unique_id ORDER BY w.number_of_likes DESC NULLS LAST, w.unique_id))[1],
+       max(w.number_of_shares),
+       (array_agg(w.unique_id ORDER BY w.number_of_shares DESC NULLS LAST, w.unique_id))[1]
+"""
+ROLLUP_COLUMNS = "(token, month, tweet_count, like_sum, share_sum, max_likes, max_likes_id, max_shares, max_shares_id)"
+
+# tweets is partitioned by month on date_time, so queries limited to a time window only scan the
+# partitions in it. Tweets without a date live in tweets_default. Unique constraints have to
+# include the partition key, and as a tweet keeps its date, (id, date_time) identifies it just
+# like id did.
+TWEETS_TABLE_COMMANDS = (
+    "CREATE SEQUENCE IF NOT EXISTS tweets_unique_id_seq",
+    """
                 CREATE TABLE IF NOT EXISTS tweets (
-                unique_id SERIAL PRIMARY KEY,
+                unique_id INT NOT NULL DEFAULT nextval('tweets_unique_id_seq'),
                 author VARCHAR(255),
                 content TEXT,
                 country VARCHAR(255), -- Nullable column
@@ -48,74 +123,602 @@ def create_tables():
                 latitude NUMERIC(10, 8), -- Nullable column
                 longitude NUMERIC(11, 8), -- Nullable column
                 number_of_likes INT,
-                number_of_shares INT
+                number_of_shares INT,
+                CONSTRAINT tweets_id_date_time_key UNIQUE NULLS NOT DISTINCT (id, date_time)
+                ) PARTITION BY RANGE (date_time)
+                """,
+    "ALTER SEQUENCE tweets_unique_id_seq OWNED BY tweets.unique_id",
+    "CREATE TABLE IF NOT EXISTS tweets_default PARTITION OF tweets DEFAULT",
+    # unique_id is no longer the primary key (it would have to include date_time), lookups by
+    # it go through this index, one probe per partition
+    "CREATE INDEX IF NOT EXISTS tweets_unique_id_idx ON tweets (unique_id)",
+)
+
+TWEETS_COLUMNS = ("unique_id, author, content, country, date_time, id, language, latitude, longitude, "
+                  "number_of_likes, number_of_shares")
+
+# Tweets already in the table (same id) are skipped; reports how many rows went in and the new
+# watermark. When any went in, the data version is bumped and their unique_id range logged. The rows that went in are added to the rollups of the tokens they match in the same
+# statement. Run it holding ROLLUP_MAINTENANCE_LOCK_KEY: inserts are then serialized, so the rows
+# get higher unique_ids than any row already rolled up, and on a tie the current argmax stays.
+MERGE_STAGING_SQL = f"""
+WITH inserted AS (
+    INSERT INTO tweets(author, content, country, date_time, id, language, latitude, longitude, number_of_likes, number_of_shares)
+    SELECT author, content, country, date_time, id, language, latitude, longitude, number_of_likes, number_of_shares
+    FROM tweets_staging
+    ON CONFLICT (id, date_time) DO NOTHING
+    RETURNING unique_id, author, content, date_time, number_of_likes, number_of_shares
+), bumped AS (
+    UPDATE data_version SET version = version + 1
+    WHERE EXISTS (SELECT 1 FROM inserted)
+    RETURNING version
+), logged AS (
+    INSERT INTO tweet_changes (version, first_id, last_id)
+    SELECT version, (SELECT min(unique_id) FROM inserted), (SELECT max(unique_id) FROM inserted) FROM bumped
+), rolled_up AS (
+    INSERT INTO token_rollups AS r {ROLLUP_COLUMNS}
+    {ROLLUP_SELECT}
+    FROM inserted w JOIN rollup_tokens t ON {ROLLUP_MATCH}
+    GROUP BY 1, 2
+    ON CONFLICT (token, month) DO UPDATE SET
+        tweet_count = r.tweet_count + EXCLUDED.tweet_count,
+        like_sum = r.like_sum + EXCLUDED.like_sum,
+        share_sum = r.share_sum + EXCLUDED.share_sum,
+        max_likes = GREATEST(r.max_likes, EXCLUDED.max_likes),
+        max_likes_id = CASE WHEN EXCLUDED.max_likes > r.max_likes OR r.max_likes IS NULL AND EXCLUDED.max_likes IS NOT NULL
+                            THEN EXCLUDED.max_likes_id ELSE r.max_likes_id END,
+        max_shares = GREATEST(r.max_shares, EXCLUDED.max_shares),
+        max_shares_id = CASE WHEN EXCLUDED.max_shares > r.max_shares OR r.max_shares IS NULL AND EXCLUDED.max_shares IS NOT NULL
+                             THEN EXCLUDED.max_shares_id ELSE r.max_shares_id END
+)
+SELECT count(*), max(unique_id) FROM inserted
+"""
+
+SAVE_CHECKPOINT_SQL = """
+INSERT INTO ingest_checkpoints(file_path, byte_offset, rows_read, rows_inserted, max_unique_id, file_size, completed, updated_at)
+VALUES (%s, %s, %s, %s, %s, %s, %s, now())
+ON CONFLICT (file_path) DO UPDATE SET
+    byte_offset = EXCLUDED.byte_offset,
+    rows_read = EXCLUDED.rows_read,
+    rows_inserted = EXCLUDED.rows_inserted,
+    max_unique_id = COALESCE(EXCLUDED.max_unique_id, ingest_checkpoints.max_unique_id),
+    file_size = EXCLUDED.file_size,
+    completed = EXCLUDED.completed,
+    updated_at = EXCLUDED.updated_at
+"""
+
+# Tweets fetched again refresh their like and share counts
+UPSERT_SQL = """
+INSERT INTO tweets(author, content, country, date_time, id, language, latitude, longitude, number_of_likes, number_of_shares)
+VALUES %s
+ON CONFLICT (id, date_time) DO UPDATE SET
+    number_of_likes = EXCLUDED.number_of_likes,
+    number_of_shares = EXCLUDED.number_of_shares
+RETURNING unique_id
+"""
+
+# Upserts can lower the likes of a row that is some month's maximum, which no increment can undo,
+# so the (token, month) rollups the upserted tweets fall in are recomputed from their rows instead.
+# Each month's tweets are joined on a date_time range, which keeps the scan to that month's
+# partition, and the no-date bucket on date_time IS NULL, which keeps it to the default partition.
+REFRESH_ROLLUPS_SQL = f"""
+WITH touched AS (
+    SELECT DISTINCT t.token, {ROLLUP_MONTH} AS month
+    FROM tweets w JOIN rollup_tokens t ON {ROLLUP_MATCH}
+    WHERE w.id = ANY(%s)
+)
+INSERT INTO token_rollups {ROLLUP_COLUMNS}
+{ROLLUP_SELECT}
+FROM touched JOIN rollup_tokens t ON t.token = touched.token
+JOIN tweets w ON {ROLLUP_MATCH} AND w.date_time >= touched.month AND w.date_time < touched.month + interval '1 month'
+WHERE touched.month <> DATE '{ROLLUP_NO_DATE}'
+GROUP BY 1, 2
+UNION ALL
+{ROLLUP_SELECT}
+FROM touched JOIN rollup_tokens t ON t.token = touched.token
+JOIN tweets w ON {ROLLUP_MATCH} AND w.date_time IS NULL
+WHERE touched.month = DATE '{ROLLUP_NO_DATE}'
+GROUP BY 1, 2
+ON CONFLICT (token, month) DO UPDATE SET
+    tweet_count = EXCLUDED.tweet_count,
+    like_sum = EXCLUDED.like_sum,
+    share_sum = EXCLUDED.share_sum,
+    max_likes = EXCLUDED.max_likes,
+    max_likes_id = EXCLUDED.max_likes_id,
+    max_shares = EXCLUDED.max_shares,
+    max_shares_id = EXCLUDED.max_shares_id
+"""
+
+# Rebuilds every rollup of one token from the whole table
+BACKFILL_ROLLUP_SQL = f"""
+INSERT INTO token_rollups {ROLLUP_COLUMNS}
+{ROLLUP_SELECT}
+FROM rollup_tokens t JOIN tweets w ON {ROLLUP_MATCH}
+WHERE t.token = %s
+GROUP BY 1, 2
+"""
+
+# The words found in the most tweets, through the same tsvector as the full-text index
+TOP_WORDS_SQL = """
+SELECT word FROM ts_stat($$SELECT to_tsvector('simple', coalesce(content, '')) FROM tweets WHERE author <> 'None'$$)
+ORDER BY ndoc DESC, word
+LIMIT %s
+"""
+
+# Every transaction that changes tweets bumps this counter, which callers caching results derived
+# from the table (the micro-manager's result cache) poll through /data-version, and logs the
+# unique_ids it inserted or updated in tweet_changes under the new version. The bump locks the
+# version row until commit, so versions commit in order: a consumer that read version N sees every
+# row logged up to N, whatever order concurrent writers handed out their unique_ids in.
+LOG_CHANGES_SQL = """
+WITH bumped AS (
+    UPDATE data_version SET version = version + 1 RETURNING version
+)
+INSERT INTO tweet_changes (version, first_id, last_id)
+SELECT version, unique_id, unique_id FROM bumped, unnest(%s::int[]) AS changed(unique_id)
+"""
+
+PRUNE_CHANGES_SQL = "DELETE FROM tweet_changes WHERE version <= (SELECT version FROM data_version) - %s"
+
+
+def create_tables():
+    commands = TWEETS_TABLE_COMMANDS + (
+        """
+                CREATE TABLE IF NOT EXISTS ingest_checkpoints (
+                file_path TEXT PRIMARY KEY,
+                byte_offset BIGINT NOT NULL DEFAULT 0, -- Where the next run resumes reading
+                rows_read BIGINT NOT NULL DEFAULT 0,
+                rows_inserted BIGINT NOT NULL DEFAULT 0,
+                max_unique_id INT, -- Highest unique_id inserted from this file
+                file_size BIGINT,
+                completed BOOLEAN NOT NULL DEFAULT FALSE,
+                updated_at TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT now()
+                )
+                """,
+        """
+                CREATE TABLE IF NOT EXISTS data_version (
+                singleton BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (singleton), -- Exactly one row
+                version BIGINT NOT NULL DEFAULT 0
                 )
-                """
+                """,
+        "INSERT INTO data_version DEFAULT VALUES ON CONFLICT DO NOTHING",
+        """
+                CREATE TABLE IF NOT EXISTS tweet_changes (
+                version BIGINT NOT NULL, -- data_version that made the changes
+                first_id INT NOT NULL, -- unique_id range holding the changed rows, possibly among others
+                last_id INT NOT NULL
+                )
+                """,
+        "CREATE INDEX IF NOT EXISTS tweet_changes_version_idx ON tweet_changes (version)",
+        """
+                CREATE TABLE IF NOT EXISTS rollup_tokens (
+                token TEXT PRIMARY KEY, -- Lower case
+                ready BOOLEAN NOT NULL DEFAULT FALSE, -- Backfilled, its rollups cover every tweet
+                created_at TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT now()
+                )
+                """,
+        f"""
+                CREATE TABLE IF NOT EXISTS token_rollups (
+                token TEXT NOT NULL REFERENCES rollup_tokens ON DELETE CASCADE,
+                month DATE NOT NULL, -- {ROLLUP_NO_DATE} for tweets without a date
+                tweet_count BIGINT NOT NULL,
+                like_sum BIGINT NOT NULL,
+                share_sum BIGINT NOT NULL,
+                max_likes INT,
+                max_likes_id INT, -- unique_id of the month's most liked tweet
+                max_shares INT,
+                max_shares_id INT,
+                PRIMARY KEY (token, month)
+                )
+                """,
     )
-    conn = None
     try:
-        # Connect to the database
-        conn = connect_to_db()
-        cur = conn.cursor()
-        # Create table one by one
-        for command in commands:
-            cur.execute(command)
-        # Close communication with the database
-        cur.close()
-        # Commit the changes
+        # Borrow a pooled connection to the database
+        with db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT pg_advisory_xact_lock(%s)", (PARTITION_LOCK_KEY,))
+            partition_existing_table(cur)
+            # Create table one by one
+            for command in commands:
+                cur.execute(command)
+            # Close communication with the database
+            cur.close()
+            # Commit the changes
+            conn.commit()
+    except (Exception, psycopg2.DatabaseError) as error:
+        print(error)
+
+
+def partition_existing_table(cur):
+    # A tweets table from before partitioning is rebuilt as a partitioned one, in the caller's
+    # transaction so readers see either table whole. Rows are copied once, keeping the first
+    # copy of any duplicate, and their unique_ids and sequence are kept.
+    cur.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass('tweets')")
+    row = cur.fetchone()
+    if row is None or row[0] == 'p':
+        return
+    start = time.monotonic()
+    cur.execute("LOCK TABLE tweets IN ACCESS EXCLUSIVE MODE")
+    # Index names are per schema, the search indexes are rebuilt on the new table afterwards
+    for name, _ in SEARCH_INDEXES:
+        cur.execute(f"DROP INDEX IF EXISTS {name}")
+    cur.execute("ALTER TABLE tweets RENAME TO tweets_unpartitioned")
+    for command in TWEETS_TABLE_COMMANDS:
+        cur.execute(command)
+    cur.execute("SELECT DISTINCT date_trunc('month', date_time)::date FROM tweets_unpartitioned WHERE date_time IS NOT NULL")
+    create_partitions(cur, [row[0] for row in cur.fetchall()])
+    cur.execute(f"INSERT INTO tweets ({TWEETS_COLUMNS}) SELECT {TWEETS_COLUMNS} FROM tweets_unpartitioned "
+                "ORDER BY unique_id ON CONFLICT DO NOTHING")
+    copied = cur.rowcount
+    cur.execute("DROP TABLE tweets_unpartitioned")
+    app.logger.info(f"Partitioned tweets, {copied} rows in {time.monotonic() - start:.1f}s")
+
+
+def partition_name(month):
+    return f"tweets_y{month:%Y}m{month:%m}"
+
+
+def month_start(date_time):
+    # First day of the month of a datetime or 'YYYY-MM-DD HH:MM:SS' string, None without a date
+    if not date_time:
+        return None
+    if isinstance(date_time, str):
+        return date(int(date_time[:4]), int(date_time[5:7]), 1)
+    return date(date_time.year, date_time.month, 1)
+
+
+def create_partitions(cursor, months):
+    # One partition per month, [first day, first day of the next month). Postgres refuses to
+    # create a partition over rows tweets_default holds, so any of that month which ended up
+    # there (e.g. a timezone away from a month boundary) are moved into the new partition.
+    for month in sorted(months):
+        name = partition_name(month)
+        cursor.execute("SELECT to_regclass(%s)", (name,))
+        if cursor.fetchone()[0] is not None:
+            continue
+        bounds = (month, date(month.year + month.month // 12, month.month % 12 + 1, 1))
+        cursor.execute("CREATE TEMP TABLE tweets_moved (LIKE tweets)")
+        cursor.execute("WITH moved AS (DELETE FROM tweets_default WHERE date_time >= %s AND date_time < %s RETURNING *) "
+                       "INSERT INTO tweets_moved SELECT * FROM moved", bounds)
+        cursor.execute(f"CREATE TABLE {name} PARTITION OF tweets FOR VALUES FROM (%s) TO (%s)", bounds)
+        cursor.execute("INSERT INTO tweets SELECT * FROM tweets_moved")
+        cursor.execute("DROP TABLE tweets_moved")
+
+
+_partitions = set()  # Months this process has made sure have a partition
+_partitions_lock = threading.Lock()
+
+
+def ensure_partitions(conn, months):
+    # Create the partitions rows of these months are about to be inserted into, so none of them
+    # lands in tweets_default (a partition can't be created over rows the default one holds).
+    # Creating a partition locks the whole table, so this is committed on its own right away
+    # rather than held until the rows are in: call it with no transaction open.
+    months = {month for month in months if month is not None}
+    with _partitions_lock:
+        missing = months - _partitions
+    if not missing:
+        return
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT pg_advisory_xact_lock(%s)", (PARTITION_LOCK_KEY,))
+        create_partitions(cursor, missing)
         conn.commit()
+    except psycopg2.DatabaseError:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+    with _partitions_lock:
+        _partitions.update(missing)
+
+
+def migrate_search_indexes():
+    # Build whichever search indexes are missing. A partitioned index is created ON ONLY the
+    # parent, where it stays invalid until every partition has its own copy attached. The copies
+    # are built with CREATE INDEX CONCURRENTLY, which keeps the table open to reads and writes
+    # meanwhile, so this is safe on a large live table, at the price of running outside a
+    # transaction: an interrupted build leaves an invalid copy that is dropped and rebuilt on
+    # the next run. Partitions created later get their copy from the parent index.
+    try:
+        with db_connection() as conn:
+            conn.autocommit = True
+            cursor = conn.cursor()
+            cursor.execute("SELECT pg_try_advisory_lock(%s)", (MIGRATION_LOCK_KEY,))
+            if not cursor.fetchone()[0]:
+                return
+            try:
+                trigrams = SEARCH_TRGM_INDEX
+                if trigrams:
+                    try:
+                        cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+                    except psycopg2.Error as error:
+                        app.logger.info(f"pg_trgm is not available, skipping the trigram index: {error}")
+                        trigrams = False
+                indexes = [index for index in SEARCH_INDEXES if trigrams or index[0] != "tweets_content_trgm_idx"]
+
+                for name, definition in indexes:
+                    if index_validity(cursor, name):
+                        continue
+                    start = time.monotonic()
+                    cursor.execute(f"CREATE INDEX IF NOT EXISTS {name} ON ONLY tweets {definition}")
+                    build_partition_indexes(cursor, name, definition)
+                    app.logger.info(f"Built {name} in {time.monotonic() - start:.1f}s")
+            finally:
+                cursor.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK_KEY,))
+                cursor.close()
+    except (Exception, psycopg2.DatabaseError) as error:
+        print(error)
+
+
+def select_rollup_tokens():
+    # Register the configured rollup tokens, plus the most frequent words until ROLLUP_TOP_WORDS
+    # tokens are registered, and backfill them. Counting word frequencies scans the whole
+    # table, so one worker does it and the others skip it.
+    try:
+        tokens = list(ROLLUP_TOKENS)
+        if ROLLUP_TOP_WORDS > 0:
+            with db_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute("SELECT count(*) FROM rollup_tokens")
+                registered = cursor.fetchone()[0]
+                cursor.execute("SELECT pg_try_advisory_xact_lock(%s)", (ROLLUP_LOCK_KEY,))
+                if registered < ROLLUP_TOP_WORDS and cursor.fetchone()[0]:
+                    with db_query("top_words") as query:
+                        cursor.execute(TOP_WORDS_SQL, (ROLLUP_TOP_WORDS,))
+                        words = [row[0] for row in cursor.fetchall()]
+                        query["rows"] = len(words)
+                    tokens.extend(words)
+                conn.commit()
+                cursor.close()
+        register_rollup_tokens(tokens)
     except (Exception, psycopg2.DatabaseError) as error:
         print(error)
+
+
+def normalize_rollup_tokens(tokens):
+    return sorted({token.strip().lower() for token in tokens if token.strip()})
+
+
+def register_rollup_tokens(tokens):
+    tokens = normalize_rollup_tokens(tokens)
+    try:
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            if tokens:
+                execute_values(cursor, "INSERT INTO rollup_tokens (token) VALUES %s ON CONFLICT DO NOTHING",
+                               [(token,) for token in tokens])
+                conn.commit()
+            try:
+                backfill_rollups(conn, cursor)
+            finally:
+                cursor.close()
+    except (Exception, psycopg2.DatabaseError) as error:
+        print(error)
+
+
+def backfill_rollups(conn, cursor):
+    # Build the rollups of every token that is not ready yet, one transaction per token. It holds
+    # a SHARE lock on tweets: taking it waits for the inserts in flight, which may have started
+    # before the token was registered and left it out, and holding it keeps new ones out until
+    # the rollups are complete. Those then find the token registered and add their own rows.
+    cursor.execute("SELECT pg_advisory_lock(%s)", (ROLLUP_LOCK_KEY,))
+    try:
+        while True:
+            cursor.execute("SELECT token FROM rollup_tokens WHERE NOT ready ORDER BY created_at, token LIMIT 1")
+            row = cursor.fetchone()
+            if row is None:
+                return
+            token = row[0]
+            start = time.monotonic()
+            cursor.execute("LOCK TABLE tweets IN SHARE MODE")
+            cursor.execute("DELETE FROM token_rollups WHERE token = %s", (token,))
+            with db_query("backfill_rollup") as query:
+                cursor.execute(BACKFILL_ROLLUP_SQL, (token,))
+                query["rows"] = cursor.rowcount
+            cursor.execute("UPDATE rollup_tokens SET ready = TRUE WHERE token = %s", (token,))
+            conn.commit()
+            app.logger.info(f"Rolled up '{token}' in {time.monotonic() - start:.1f}s")
     finally:
-        if conn is not None:
-            conn.close()
+        conn.rollback()
+        cursor.execute("SELECT pg_advisory_unlock(%s)", (ROLLUP_LOCK_KEY,))
+        conn.commit()
+
+
+def index_validity(cursor, name):
+    # True for a valid index, False for an invalid one, None when there is none
+    cursor.execute("SELECT i.indisvalid FROM pg_class c JOIN pg_index i ON i.indexrelid = c.oid "
+                   "WHERE c.relname = %s", (name,))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def build_partition_indexes(cursor, name, definition):
+    # Build and attach the copy of the partitioned index `name` of every partition lacking one
+    cursor.execute("SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+                   "WHERE i.inhparent = 'tweets'::regclass ORDER BY c.relname")
+    for (partition,) in cursor.fetchall():
+        cursor.execute("SELECT 1 FROM pg_inherits i JOIN pg_index x ON x.indexrelid = i.inhrelid "
+                       "WHERE i.inhparent = %s::regclass AND x.indrelid = %s::regclass", (name, partition))
+        if cursor.fetchone():
+            continue
+        partition_index = f"{partition}_{name[len('tweets_'):]}"
+        valid = index_validity(cursor, partition_index)
+        if valid is False:
+            cursor.execute(f"DROP INDEX CONCURRENTLY {partition_index}")
+        if not valid:
+            cursor.execute(f"CREATE INDEX CONCURRENTLY {partition_index} ON {partition} {definition}")
+        cursor.execute(f"ALTER INDEX {name} ATTACH PARTITION {partition_index}")
+
+
+class OffsetLineReader:
+    # Iterates over the lines of a binary file while tracking the byte offset just past the
+    # last line handed out, which is where a later run can resume. Files dropped into the
+    # ingest directory should appear atomically (written elsewhere, then renamed).
+
+    def __init__(self, f):
+        self.f = f
+        self.offset = f.tell()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        line = self.f.readline()
+        if not line:
+            raise StopIteration
+        self.offset += len(line)
+        return line.decode('utf-8')
+
+
+def read_csv_chunks(lines, chunk_rows, skip_header):
+    # Stream the CSV as COPY-ready chunks of at most chunk_rows rows, each with the byte offset
+    # it ends at and the months its tweets fall in. Empty fields are written unquoted, which
+    # COPY's csv format reads as NULL, and dates are converted on the way through.
+    csv_reader = csv.reader(lines)
+    if skip_header:
+        next(csv_reader, None)
+    chunk = StringIO()
+    writer = csv.writer(chunk)
+    rows = 0
+    months = set()
+    for row in csv_reader:
+        if not row:  # Blank line
+            continue
+        row[3] = parse_date(row[3])
+        months.add(month_start(row[3]))
+        writer.writerow(row)
+        rows += 1
+        if rows == chunk_rows:
+            chunk.seek(0)
+            yield chunk, rows, lines.offset, months
+            chunk = StringIO()
+            writer = csv.writer(chunk)
+            rows = 0
+            months = set()
+    if rows:
+        chunk.seek(0)
+        yield chunk, rows, lines.offset, months
 
 
 def load_csv_into_db(file_path):
-    insert_sql = """
-    INSERT INTO tweets(author, content, country, date_time, id, language, latitude, longitude, number_of_likes, number_of_shares)
-    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-    """
-    conn = None
+    # Ingest whatever part of the file has not been loaded yet. Every chunk is committed together
+    # with its checkpoint, so a crash loses at most the chunk in flight and the next run resumes
+    # from the checkpointed byte offset. Files that grew since the last run are appended.
+    file_path = os.path.abspath(file_path)
     try:
-        # Connect to the database
-        conn = connect_to_db()
-        cursor = conn.cursor()
-        
-        cursor.execute("SELECT COUNT(*) FROM tweets")
-        row_count = cursor.fetchone()[0]
-        if row_count != 0:
-            return 
-        with open(file_path, 'r', encoding='utf-8') as f:
-            csv_reader = csv.reader(f)
-            next(csv_reader)  # Skip the header
-            rows = []
-            for row in csv_reader:
-                # Convert empty strings to None for numeric fields
-                row = [None if col == '' else col for col in row]
-                row[3] = parse_date(row[3])
-                rows.append(tuple(row))
-    
-        try:
-            cursor.executemany(insert_sql, rows)
-            conn.commit()
-        except psycopg2.DatabaseError as e:
-            conn.rollback()
-        finally:
-            cursor.close()
+        # Borrow a pooled connection to the database
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT pg_try_advisory_lock(%s, hashtext(%s))", (INGEST_LOCK_KEY, file_path))
+            if not cursor.fetchone()[0]:
+                app.logger.info(f"{file_path} is already being ingested")
+                return None
+            try:
+                return ingest_file(file_path, conn, cursor)
+            finally:
+                conn.rollback()
+                cursor.execute("SELECT pg_advisory_unlock(%s, hashtext(%s))", (INGEST_LOCK_KEY, file_path))
+                conn.commit()
+                cursor.close()
     except (Exception, psycopg2.DatabaseError) as error:
         print(error)
-    finally:
-        if conn is not None:
-            conn.close()
+        return None
+
+
+def ingest_file(file_path, conn, cursor):
+    file_size = os.path.getsize(file_path)
+    cursor.execute(
+        "SELECT byte_offset, rows_read, rows_inserted FROM ingest_checkpoints WHERE file_path = %s",
+        (file_path,)
+    )
+    checkpoint = cursor.fetchone()
+    byte_offset, rows_read, rows_inserted = checkpoint or (0, 0, 0)
+    if byte_offset > file_size:
+        # The file was replaced by a shorter one, start over; rows already loaded are skipped by id
+        byte_offset, rows_read = 0, 0
+    if checkpoint and byte_offset == file_size:
+        return {"file": file_path, "rows_read": rows_read, "rows_inserted": rows_inserted, "new_rows": 0}
+
+    cursor.execute(STAGING_SQL)
+    conn.commit()
+    start = time.monotonic()
+    new_rows = 0
+    with open(file_path, 'rb') as f:
+        f.seek(byte_offset)
+        lines = OffsetLineReader(f)
+        for chunk, rows, chunk_end, months in read_csv_chunks(lines, COPY_CHUNK_ROWS, skip_header=byte_offset == 0):
+            ensure_partitions(conn, months)
+            with db_query("ingest_chunk") as query:
+                cursor.copy_expert(COPY_SQL, chunk)
+                cursor.execute("SELECT pg_advisory_xact_lock(%s)", (ROLLUP_MAINTENANCE_LOCK_KEY,))
+                cursor.execute(MERGE_STAGING_SQL)
+                inserted, max_unique_id = cursor.fetchone()
+                query["rows"] = inserted
+            rows_read += rows
+            rows_inserted += inserted
+            new_rows += inserted
+            if inserted:
+                cursor.execute(PRUNE_CHANGES_SQL, (CHANGE_LOG_VERSIONS,))
+            cursor.execute(SAVE_CHECKPOINT_SQL, (file_path, chunk_end, rows_read, rows_inserted, max_unique_id,
+                                                 file_size, chunk_end >= file_size))
+            conn.commit()
+            elapsed = time.monotonic() - start
+            app.logger.info(f"Loaded {rows_read} rows from {file_path}, {new_rows} new ({new_rows / max(elapsed, 1e-9):.0f} rows/sec)")
+        byte_offset = max(byte_offset, lines.offset)
+
+    # Record where reading stopped even when the tail held no new rows (e.g. only the header)
+    cursor.execute("SELECT max_unique_id FROM ingest_checkpoints WHERE file_path = %s", (file_path,))
+    row = cursor.fetchone()
+    cursor.execute(SAVE_CHECKPOINT_SQL, (file_path, byte_offset, rows_read, rows_inserted, row[0] if row else None,
+                                         file_size, byte_offset >= file_size))
+    conn.commit()
+
+    elapsed = time.monotonic() - start
+    print(f"Loaded {new_rows} new rows from {file_path} in {elapsed:.1f}s ({new_rows / max(elapsed, 1e-9):.0f} rows/sec)")
+    return {"file": file_path, "rows_read": rows_read, "rows_inserted": rows_inserted, "new_rows": new_rows}
+
+
+def ingest_directory(directory):
+    # Load every CSV in the directory; files that are fully checkpointed are skipped cheaply
+    if not os.path.isdir(directory):
+        return
+    for name in sorted(os.listdir(directory)):
+        if name.endswith('.csv'):
+            load_csv_into_db(os.path.join(directory, name))
+
+
+def watch_ingest_directory():
+    while True:
+        ingest_directory(INGEST_DIR)
+        time.sleep(INGEST_POLL_SECONDS)
+
+
+_watcher_started = False
+_watcher_lock = threading.Lock()
+
+
+def start_ingest_watcher():
+    global _watcher_started
+    with _watcher_lock:
+        if _watcher_started or INGEST_POLL_SECONDS <= 0:
+            return
+        _watcher_started = True
+    threading.Thread(target=watch_ingest_directory, name="ingest-watcher", daemon=True).start()
 
 
 @app.before_first_request
 def startup():
     # Create tables if they don't exist
     create_tables()
-    # Load CSV data into the database
+    # Build the search indexes in the background, on a large table that takes a while
+    threading.Thread(target=migrate_search_indexes, name="search-index-migration", daemon=True).start()
+    # Load CSV data into the database, resuming from the last checkpoint
     load_csv_into_db("tweets.csv")
+    # Then pick and backfill the rollup tokens, the most frequent words are only known by now
+    threading.Thread(target=select_rollup_tokens, name="rollup-tokens", daemon=True).start()
+    # Keep picking up new CSV drops
+    start_ingest_watcher()
 
 
 @app.route('/')
@@ -123,51 +726,165 @@ def hello():
     return "Hello, the tables should be set up now!"
 
 
+@app.route('/ingest', methods=['POST'])
+def ingest():
+    # Queue a CSV from the ingest directory for loading; progress is visible through GET /ingest
+    file_name = (request.json or {}).get('file')
+    if not file_name:
+        return jsonify({"error": "file is required"}), 400
+    ingest_dir = os.path.realpath(INGEST_DIR)
+    file_path = os.path.realpath(os.path.join(ingest_dir, file_name))
+    if not file_path.startswith(ingest_dir + os.sep):
+        return jsonify({"error": "file must be inside the ingest directory"}), 400
+    if not os.path.isfile(file_path):
+        return jsonify({"error": f"{file_name} not found"}), 404
+    threading.Thread(target=load_csv_into_db, args=(file_path,), daemon=True).start()
+    return jsonify({"message": "Ingestion started", "file": file_path}), 202
+
+
+@app.route('/ingest', methods=['GET'])
+def ingest_status():
+    try:
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT file_path, byte_offset, file_size, rows_read, rows_inserted, max_unique_id, "
+                           "completed, updated_at FROM ingest_checkpoints ORDER BY updated_at DESC")
+            columns = [column[0] for column in cursor.description]
+            checkpoints = [dict(zip(columns, row)) for row in cursor.fetchall()]
+            cursor.close()
+        return jsonify(checkpoints)
+    except (Exception, psycopg2.DatabaseError) as error:
+        print(error)
+        return jsonify({"error": str(error)}), 500
+
+
+@app.route('/data-version')
+def get_data_version():
+    try:
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT version FROM data_version")
+            row = cursor.fetchone()
+            cursor.close()
+        return jsonify({"version": row[0] if row else 0})
+    except (Exception, psycopg2.DatabaseError) as error:
+        print(error)
+        return jsonify({"error": str(error)}), 500
+
+
+@app.route('/rollup-tokens', methods=['GET'])
+def get_rollup_tokens():
+    try:
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT t.token, t.ready, t.created_at, count(r.month), COALESCE(sum(r.tweet_count), 0) "
+                           "FROM rollup_tokens t LEFT JOIN token_rollups r ON r.token = t.token "
+                           "GROUP BY t.token ORDER BY t.token")
+            tokens = [{"token": token, "ready": ready, "created_at": created_at, "months": months, "tweets": tweets}
+                      for token, ready, created_at, months, tweets in cursor.fetchall()]
+            cursor.close()
+        return jsonify(tokens)
+    except (Exception, psycopg2.DatabaseError) as error:
+        print(error)
+        return jsonify({"error": str(error)}), 500
+
+
+@app.route('/rollup-tokens', methods=['POST'])
+def add_rollup_tokens():
+    # Start keeping rollups for more tokens; backfilling them is visible through GET /rollup-tokens
+    tokens = (request.json or {}).get('tokens')
+    if not isinstance(tokens, list) or not all(isinstance(token, str) for token in tokens):
+        return jsonify({"error": "tokens must be a list of strings"}), 400
+    threading.Thread(target=register_rollup_tokens, args=(tokens,), daemon=True).start()
+    return jsonify({"message": "Rollups started", "tokens": normalize_rollup_tokens(tokens)}), 202
+
+
+@app.route('/pool-stats')
+def get_pool_stats():
+    return jsonify(pool_stats())
+
+
+def upsert_tweets(rows, conn):
+    # One multi-row statement per batch. A tweet may appear twice in a batch (search pages
+    # overlap), and ON CONFLICT DO UPDATE refuses to touch a row twice, so keep its latest copy.
+    rows = list({row[4]: row for row in rows}.values())
+    ensure_partitions(conn, {month_start(row[3]) for row in rows})
+    cursor = conn.cursor()
+    try:
+        # Otherwise a merge committing while the rollups are recomputed, from a snapshot without
+        # its rows, would have its increments overwritten
+        cursor.execute("SELECT pg_advisory_xact_lock(%s)", (ROLLUP_MAINTENANCE_LOCK_KEY,))
+        with db_query("upsert_tweets") as query:
+            changed = execute_values(cursor, UPSERT_SQL, rows, page_size=len(rows), fetch=True)
+            query["rows"] = len(rows)
+        with db_query("refresh_rollups") as query:
+            cursor.execute(REFRESH_ROLLUPS_SQL, ([row[4] for row in rows],))
+            query["rows"] = cursor.rowcount
+        cursor.execute(LOG_CHANGES_SQL, ([row[0] for row in changed],))
+        cursor.execute(PRUNE_CHANGES_SQL, (CHANGE_LOG_VERSIONS,))
+        conn.commit()
+    except psycopg2.DatabaseError:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+    return len(rows)
+
+
+def write_batches(write_queue, batches, errors):
+    # Upserts the queued pages until the None sentinel
+    try:
+        with db_connection() as conn:
+            while True:
+                rows = write_queue.get()
+                if rows is None:
+                    return
+                if not rows:
+                    continue
+                start = time.monotonic()
+                written = upsert_tweets(rows, conn)
+                elapsed = time.monotonic() - start
+                batch = {"rows": written, "seconds": round(elapsed, 4), "rows_per_sec": round(written / max(elapsed, 1e-9))}
+                batches.append(batch)
+                app.logger.info(f"Upserted batch {len(batches)}: {batch}")
+    except Exception as e:
+        errors.append(e)
+        # Keep draining so the fetching side never blocks on a full queue
+        while write_queue.get() is not None:
+            pass
+
+
 @app.route('/grab-tweets', methods=['POST'])
 def grab_tweets_from_api():
     tokens = request.json['tokens']
-    api = connect_to_api()
     search_query = " ".join(tokens)
 
     try:
-        # Fetch tweets
-        tweets = api.search(q=search_query, count=100)  # Adjust count as needed
-
-        # Process and insert tweets into the database
-        for tweet in tweets:
-            # Extract required fields from each tweet
-            author = tweet.user.screen_name
-            content = tweet.text
-            country = None  # This might require additional logic based on tweet.place
-            date_time = tweet.created_at
-            tweet_id = tweet.id_str
-            language = tweet.lang
-            latitude = None if tweet.coordinates is None else tweet.coordinates['coordinates'][1]
-            longitude = None if tweet.coordinates is None else tweet.coordinates['coordinates'][0]
-            number_of_likes = tweet.favorite_count
-            number_of_shares = tweet.retweet_count
-
-            # Prepare data for insertion
-            tweet_data = (author, content, country, date_time, tweet_id, language, latitude, longitude, number_of_likes, number_of_shares)
-
-            # Insert tweet into database (simplified version)
-            insert_sql = """
-            INSERT INTO tweets(author, content, country, date_time, id, language, latitude, longitude, number_of_likes, number_of_shares)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-            """
-            conn = connect_to_db()
-            cursor = conn.cursor()
-            try:
-                cursor.execute(insert_sql, tweet_data)
-                conn.commit()
-            except psycopg2.DatabaseError as e:
-                conn.rollback()
-                print(e)
-            finally:
-                cursor.close()
-                conn.close()
+        source = get_tweet_source(request.json.get('source', TWEET_SOURCE))
+        max_pages = int(request.json.get('max_pages', GRAB_MAX_PAGES))
+
+        # Fetched pages feed a bounded queue that a writer thread upserts batch by batch
+        write_queue = queue.Queue(maxsize=GRAB_QUEUE_SIZE)
+        batches = []
+        errors = []
+        writer = threading.Thread(target=write_batches, args=(write_queue, batches, errors), daemon=True)
+        writer.start()
+        try:
+            for page in source.pages(search_query, max_pages, GRAB_PAGE_SIZE):
+                write_queue.put(page)
+                if errors:
+                    break
+        finally:
+            write_queue.put(None)
+            writer.join()
 
-        return jsonify({"message": "Tweets fetched and inserted successfully."}), 200
+        if errors:
+            raise errors[0]
+        return jsonify({
+            "message": "Tweets fetched and inserted successfully.",
+            "rows": sum(batch["rows"] for batch in batches),
+            "batches": batches
+        }), 200
     except Exception as e:
         print(e)
         return jsonify({"error": "Failed to fetch or insert tweets"}), 500
@@ -185,5 +902,5 @@ def parse_date(date_str):
     
 
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0', port=3999)
+    app.run(debug=os.getenv('FLASK_DEBUG') == '1', host='0.0.0.0', port=3999)
     
\ No newline at end of file
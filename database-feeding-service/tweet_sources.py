@@ -0,0 +1,91 @@
+import os
+import random
+import zlib
+from datetime import datetime, timedelta
+
+import tweepy
+
+api_key = os.getenv('TWITTER_API_KEY')
+api_secret_key = os.getenv('TWITTER_API_SECRET_KEY')
+access_token = os.getenv('TWITTER_ACCESS_TOKEN')
+access_token_secret = os.getenv('TWITTER_ACCESS_TOKEN_SECRET')
+
+# Every source yields pages of rows in the column order of the tweets table (minus unique_id):
+# (author, content, country, date_time, id, language, latitude, longitude, number_of_likes, number_of_shares)
+
+
+def connect_to_api():
+    auth = tweepy.OAuthHandler(api_key, api_secret_key)
+    auth.set_access_token(access_token, access_token_secret)
+    api = tweepy.API(auth)
+    return api
+
+
+class TwitterSource:
+    # Pages through the Twitter search API
+
+    def __init__(self):
+        self.api = connect_to_api()
+
+    def pages(self, query, max_pages, page_size):
+        cursor = tweepy.Cursor(self.api.search_tweets, q=query, count=page_size)
+        for page in cursor.pages(max_pages):
+            yield [self.to_row(tweet) for tweet in page]
+
+    @staticmethod
+    def to_row(tweet):
+        # Extract required fields from each tweet
+        author = tweet.user.screen_name
+        content = tweet.text
+        country = None  # This might require additional logic based on tweet.place
+        date_time = tweet.created_at
+        tweet_id = tweet.id_str
+        language = tweet.lang
+        latitude = None if tweet.coordinates is None else tweet.coordinates['coordinates'][1]
+        longitude = None if tweet.coordinates is None else tweet.coordinates['coordinates'][0]
+        number_of_likes = tweet.favorite_count
+        number_of_shares = tweet.retweet_count
+        return (author, content, country, date_time, tweet_id, language, latitude, longitude, number_of_likes, number_of_shares)
+
+
+class FakeSource:
+    # Local stand-in for Twitter in tests and benchmarks. Tweets are derived from the query and
+    # a seed, so the same search returns the same ids and repeated grabs exercise the upsert path.
+
+    def __init__(self, seed=0):
+        self.seed = seed
+
+    def pages(self, query, max_pages, page_size):
+        rng = random.Random(f"{self.seed}:{query}")
+        words = query.split() or ["tweet"]
+        start = datetime(2021, 1, 1)
+        for page in range(max_pages):
+            rows = []
+            for i in range(page_size):
+                number = page * page_size + i
+                content = " ".join(rng.choice(words) for _ in range(rng.randint(1, 8)))
+                rows.append((
+                    f"fake_user_{rng.randint(1, 1000)}",
+                    content,
+                    None,
+                    start + timedelta(minutes=rng.randint(0, 525600)),
+                    f"fake-{zlib.crc32(query.encode())}-{number}",
+                    "en",
+                    None,
+                    None,
+                    rng.randint(0, 5000),
+                    rng.randint(0, 1000),
+                ))
+            yield rows
+
+
+TWEET_SOURCES = {
+    "twitter": TwitterSource,
+    "fake": FakeSource,
+}
+
+
+def get_tweet_source(name):
+    if name not in TWEET_SOURCES:
+        raise ValueError(f"Unknown tweet source '{name}'")
+    return TWEET_SOURCES[name]()
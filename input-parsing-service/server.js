@@ -1,22 +1,67 @@
 const express = require('express');
 const bodyParser = require('body-parser');
 const axios = require('axios');
+const crypto = require('crypto');
+const fs = require('fs');
 
 const app = express();
 const port = process.env.PORT || 3002;
 
+// Every request gets a W3C trace context here, at the edge, and the services downstream continue
+// it. With TRACE_FILE set, this hop's span is appended there as one JSON line.
+const TRACE_FILE = process.env.TRACE_FILE;
+
+function startTrace(req) {
+    // Continue the caller's trace when it sent one, otherwise start a new one
+    const match = /^00-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}$/.exec(req.get('traceparent') || '');
+    const trace = {
+        traceId: match ? match[1] : crypto.randomBytes(16).toString('hex'),
+        parentSpanId: match ? match[2] : null,
+        spanId: crypto.randomBytes(8).toString('hex'),
+        startTime: Date.now() / 1000
+    };
+    trace.headers = { traceparent: `00-${trace.traceId}-${trace.spanId}-01` };
+    return trace;
+}
+
+function endTrace(trace, name, attributes) {
+    if (!TRACE_FILE) {
+        return;
+    }
+    const span = {
+        service: 'input-parsing-service',
+        trace_id: trace.traceId,
+        span_id: trace.spanId,
+        parent_span_id: trace.parentSpanId,
+        name: name,
+        kind: 2,
+        start_time: trace.startTime,
+        duration_ms: Math.round((Date.now() / 1000 - trace.startTime) * 1e6) / 1000,
+        attributes: attributes,
+        error: null
+    };
+    fs.appendFile(TRACE_FILE, JSON.stringify(span) + '\n', (error) => {
+        if (error) {
+            console.error('Could not write span:', error);
+        }
+    });
+}
+
 // Middleware to parse request bodies
 app.use(bodyParser.urlencoded({ extended: true }));
 app.use(bodyParser.json());
 
 app.post('/parse-input', async (req, res) => {
-    const { tokens, source } = req.body;
+    const { tokens, source, granularity, format, stream, engine, since, until } = req.body;
+    const trace = startTrace(req);
+    res.setHeader('X-Trace-Id', trace.traceId);
+    res.on('finish', () => endTrace(trace, 'POST /parse-input', { 'http.status_code': res.statusCode }));
 
     // Example of parsing input. You might need to adjust based on actual input format.
     const parsedTokens = tokens.split(/\s+|[,.;!?\\:]+/).filter(Boolean); // Assuming tokens are sent as a space-separated string
 
     try {
-        await axios.get('http://database-feeding-service:3999/'); // Adjust the URL to your Flask service
+        await axios.get('http://database-feeding-service:3999/', { headers: trace.headers }); // Adjust the URL to your Flask service
         console.log('The database now contains tweets.csv');
     } catch (error) {
         console.error('Error initializing Flask service:', error);
@@ -30,7 +75,7 @@ app.post('/parse-input', async (req, res) => {
             // and it expects a POST request with a JSON body containing a "status" field
             const tweetResponse = await axios.post('http://tweet-uploading-service:3020/post-tweet', {
                 status: tokens // Assuming the entire tokens string is the tweet text
-            });
+            }, { headers: trace.headers });
 
             // Check the response from tweet-uploading-service
             if (tweetResponse.status === 200) {
@@ -66,18 +111,39 @@ app.post('/parse-input', async (req, res) => {
 
     // Send parsed tokens to the token-finding-service
     try {
+        const streamed = Boolean(stream); // Optional: send the page to the browser piece by piece
         const response = await axios.post('http://micro-manager-service:3010/handle-request', {
-            tokens: parsedTokens
+            tokens: parsedTokens,
+            granularity: granularity, // Optional: day, week, month (default) or year
+            format: format, // Optional: png (default), client or json
+            engine: engine, // Optional: index (default), ilike or fts (whole words)
+            since: since || undefined, // Optional time window [since, until), ISO dates; empty form fields mean no bound
+            until: until || undefined,
+            stream: streamed
+        }, {
+            // Let callers force a fresh result past the manager's result cache
+            headers: req.get('X-Cache-Bypass') ? { ...trace.headers, 'X-Cache-Bypass': req.get('X-Cache-Bypass') } : trace.headers,
+            responseType: streamed ? 'stream' : 'json'
         });
         const contentType = response.headers['content-type'];
+        if (response.headers['x-cache']) {
+            res.setHeader('X-Cache', response.headers['x-cache']);
+        }
+
+        if (streamed) {
+            // Relay each chunk as soon as the manager sends it
+            res.setHeader('Content-Type', contentType);
+            res.setHeader('X-Accel-Buffering', 'no');
+            return response.data.pipe(res);
+        }
 
         // If the response is HTML, send it as HTML; otherwise, send it as JSON
         if (contentType.includes('text/html')) {
             res.setHeader('Content-Type', 'text/html');
             res.send(response.data); // Send HTML response directly
         } else {
-            // For JSON or other types of content
-            res.json(JSON.parse(response.data)); // Parse and send JSON response
+            // For JSON or other types of content, axios has already parsed JSON bodies
+            res.json(response.data);
         }
     } catch (error) {
         console.error('Error sending tokens to token-finding-service:', error);
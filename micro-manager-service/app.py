@@ -1,42 +1,392 @@
-import requests
+import asyncio
+import json
+import os
+import queue
+import threading
+import time
+
+import aiohttp
 from flask import Flask, request, jsonify, Response
+from prometheus_client import Counter, Histogram
+
+import metrics
+import tracing
+from result_cache import ResultCache, normalize_tokens
+from singleflight import SingleFlight
 
 app = Flask(__name__)
+metrics.init_app(app)
+tracing.init_app(app)
+
+# Downstream services
+TOKEN_FINDING_URL = os.getenv("TOKEN_FINDING_URL", "http://token-finding-service:3003/find-tweets")
+TWEET_ANALYZING_URL = os.getenv("TWEET_ANALYZING_URL", "http://tweet-analyzing-service:3004/analyze-tweets")
+ANALYSIS_VISUALIZER_URL = os.getenv("ANALYSIS_VISUALIZER_URL", "http://analysis-visualizer-service:3005/visualize")
+DATA_VERSION_URL = os.getenv("DATA_VERSION_URL", "http://database-feeding-service:3999/data-version")
+
+# Finished responses are cached per normalized request for RESULT_CACHE_TTL seconds (at most
+# RESULT_CACHE_MAX_ENTRIES of them, also on disk when RESULT_CACHE_DIR is set) and dropped as soon
+# as the tweets table changes. The table's data version is re-read at most every DATA_VERSION_TTL
+# seconds, so new rows can take that long to show up in cached results.
+result_cache = ResultCache(
+    max_entries=int(os.getenv("RESULT_CACHE_MAX_ENTRIES", "1000")),
+    ttl=float(os.getenv("RESULT_CACHE_TTL", "300")),
+    directory=os.getenv("RESULT_CACHE_DIR") or None
+)
+DATA_VERSION_TTL = float(os.getenv("DATA_VERSION_TTL", "5"))
+DATA_VERSION_TIMEOUT = float(os.getenv("DATA_VERSION_TIMEOUT", "2"))
+
+# Seconds each stage may take per attempt, how many times a failed attempt is retried and the
+# base of the exponential backoff between attempts
+FIND_TIMEOUT = float(os.getenv("FIND_TIMEOUT", "60"))
+ANALYZE_TIMEOUT = float(os.getenv("ANALYZE_TIMEOUT", "60"))
+VISUALIZE_TIMEOUT = float(os.getenv("VISUALIZE_TIMEOUT", "120"))
+STAGE_RETRIES = int(os.getenv("STAGE_RETRIES", "2"))
+STAGE_BACKOFF = float(os.getenv("STAGE_BACKOFF", "0.5"))
+
+# How token-finding hands its id sets to tweet-analyzing: "binary" (compact, see idset.py in
+# either service) or "json"
+ID_SET_FORMAT = os.getenv("ID_SET_FORMAT", "binary")
+ID_SET_CONTENT_TYPE = "application/x-idset"
+
+# Keep-alive connections shared by all requests of a worker process
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "100"))
+
+# Analyses a streamed request keeps in flight at once
+STREAM_ANALYZE_CONCURRENCY = int(os.getenv("STREAM_ANALYZE_CONCURRENCY", "8"))
+
+# Responses worth another attempt: the service is restarting or overloaded
+RETRY_STATUSES = (502, 503, 504)
+
+DOWNSTREAM_LATENCY = Histogram(
+    "downstream_request_duration_seconds", "Time spent on each attempt at a downstream call (until the "
+    "response starts for streamed ones)", ["service", "status"]
+)
+RESULT_CACHE_REQUESTS = Counter("result_cache_requests_total", "Requests by result cache outcome", ["result"])
+COALESCED_REQUESTS = Counter("coalesced_requests_total", "Requests answered by an identical request's pipeline run in flight")
+
+# Identical requests arriving while one is being computed (same cache key and data version) wait
+# for it and share its response instead of running the pipeline again
+requests_in_flight = SingleFlight()
+
+
+class StageError(Exception):
+    def __init__(self, service, status_code):
+        super().__init__(f"{service} answered {status_code}")
+        self.service = service
+        self.status_code = status_code
+
+
+def found_at(params, version):
+    # Analysis parameters telling the analyzer which data version token-finding's ids are exact
+    # for, when it said; only then may it answer single words from its rollups
+    return params if version is None else dict(params, found_at=str(version))
+
+
+class Orchestrator:
+    # Runs the downstream calls on an asyncio loop in a background thread, with one pooled
+    # aiohttp session reused by every request the worker serves
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self.loop = asyncio.new_event_loop()
+        self.session = None
+        self.data_version = None
+        self.data_version_checked = 0.0
+        threading.Thread(target=self.loop.run_forever, name="orchestrator", daemon=True).start()
+
+    def run(self, coroutine):
+        # The coroutine runs in a copy of the calling thread's context, so the request's trace
+        # span is the parent of the spans it opens
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    async def get_session(self):
+        if self.session is None:
+            self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=HTTP_POOL_SIZE))
+        return self.session
+
+    async def get_data_version(self):
+        # Current version of the tweets table, or None when it can't be read (nothing is then
+        # served from or stored in the result cache)
+        if time.monotonic() - self.data_version_checked < DATA_VERSION_TTL:
+            return self.data_version
+        session = await self.get_session()
+        try:
+            async with session.get(DATA_VERSION_URL, headers=tracing.outgoing_headers(),
+                                   timeout=aiohttp.ClientTimeout(total=DATA_VERSION_TIMEOUT)) as response:
+                self.data_version = (await response.json())["version"] if response.status == 200 else None
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError, KeyError) as e:
+            app.logger.info(f"Could not read the data version: {e!r}")
+            self.data_version = None
+        self.data_version_checked = time.monotonic()
+        return self.data_version
+
+    async def call_stage(self, service, url, body, content_type, params, timeout, accept=None, response_headers=None):
+        # POST the body to one stage and return (content type, body bytes), retrying transport
+        # errors and 502/503/504 answers with exponential backoff. The response's headers are
+        # copied into the response_headers dict when one is given.
+        session = await self.get_session()
+        for attempt in range(STAGE_RETRIES + 1):
+            start = time.monotonic()
+            # One client span per attempt; the downstream service continues the trace under it
+            with tracing.span(f"POST {service}", tracing.CLIENT, **{"peer.service": service, "attempt": attempt + 1}) as call_span:
+                headers = dict(tracing.outgoing_headers(call_span), **{"Content-Type": content_type})
+                if accept:
+                    headers["Accept"] = accept
+                try:
+                    async with session.post(url, data=body, params=params, headers=headers,
+                                            timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+                        payload = await response.read()
+                        DOWNSTREAM_LATENCY.labels(service, response.status).observe(time.monotonic() - start)
+                        call_span.set_attribute("http.status_code", response.status)
+                        if response.status == 200:
+                            if response_headers is not None:
+                                response_headers.update(response.headers)
+                            return response.headers.get("Content-Type", "application/json"), payload
+                        if response.status not in RETRY_STATUSES or attempt == STAGE_RETRIES:
+                            raise StageError(service, response.status)
+                except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                    DOWNSTREAM_LATENCY.labels(service, "error").observe(time.monotonic() - start)
+                    call_span.error = repr(e)
+                    app.logger.info(f"{service} failed after {time.monotonic() - start:.3f}s (attempt {attempt + 1}): {e!r}")
+                    if attempt == STAGE_RETRIES:
+                        raise
+            await asyncio.sleep(STAGE_BACKOFF * 2 ** attempt)
+
+    async def handle(self, body, params, output_format):
+        # Each stage's response body is handed to the next stage as raw bytes: the manager never
+        # decodes or re-encodes the id lists and statistics it forwards
+        accept = ID_SET_CONTENT_TYPE if ID_SET_FORMAT == "binary" else "application/json"
+        found_headers = {}
+        content_type, found = await self.call_stage("token-finding-service", TOKEN_FINDING_URL,
+                                                    body, "application/json", {}, FIND_TIMEOUT, accept, found_headers)
+        content_type, analyzed = await self.call_stage("tweet-analyzing-service", TWEET_ANALYZING_URL,
+                                                       found, content_type, found_at(params, found_headers.get("X-Data-Version")),
+                                                       ANALYZE_TIMEOUT)
+        return await self.call_stage("analysis-visualizer-service", ANALYSIS_VISUALIZER_URL,
+                                     analyzed, content_type, dict(params, format=output_format), VISUALIZE_TIMEOUT)
+
+    async def stream_lines(self, service, url, body, params, timeout):
+        # POST the body to a streaming stage and yield its response line by line as it arrives.
+        # A half-read stream can't be replayed, so there are no retries here and the timeout
+        # bounds the wait for each line rather than the whole response.
+        session = await self.get_session()
+        start = time.monotonic()
+        call_span = tracing.start_span(f"POST {service}", tracing.CLIENT, attributes={"peer.service": service})
+        headers = dict(tracing.outgoing_headers(call_span), **{"Content-Type": "application/json"})
+        try:
+            async with session.post(url, data=body, params=params, headers=headers,
+                                    timeout=aiohttp.ClientTimeout(total=None, sock_connect=timeout, sock_read=timeout)) as response:
+                DOWNSTREAM_LATENCY.labels(service, response.status).observe(time.monotonic() - start)
+                call_span.set_attribute("http.status_code", response.status)
+                if response.status != 200:
+                    raise StageError(service, response.status)
+                # Split the lines ourselves: StreamReader's own line reading refuses lines over its
+                # buffer limit, and one subset's id list easily outgrows that
+                buffer = bytearray()
+                async for chunk in response.content.iter_any():
+                    searched = len(buffer)
+                    buffer += chunk
+                    newline = buffer.find(b"\n", searched)
+                    while newline != -1:
+                        line = bytes(buffer[:newline])
+                        del buffer[:newline + 1]
+                        if line.strip():
+                            yield line
+                        newline = buffer.find(b"\n")
+                if buffer.strip():
+                    yield bytes(buffer)
+        finally:
+            call_span.end()
+
+    async def analyze_subset(self, subset_key, ids, params, slots):
+        async with slots:
+            _, analyzed = await self.call_stage("tweet-analyzing-service", TWEET_ANALYZING_URL,
+                                                json.dumps({subset_key: ids}).encode(), "application/json",
+                                                params, ANALYZE_TIMEOUT)
+        return json.loads(analyzed)
+
+    async def render_group(self, analyses, params):
+        # Once every subset of a word-count group is analyzed, render that group's charts
+        group = {}
+        for analyzed in await asyncio.gather(*analyses):
+            group.update(analyzed)
+        if not group:
+            # The analyzer leaves out tokens without tweets (e.g. none in the time window), so a
+            # group can come back empty and has no charts to render
+            return group, b""
+        _, fragment = await self.call_stage("analysis-visualizer-service", ANALYSIS_VISUALIZER_URL,
+                                            json.dumps(group).encode(), "application/json",
+                                            dict(params, fragment="group"), VISUALIZE_TIMEOUT)
+        return group, fragment
+
+    async def stream(self, body, params, emit):
+        # Streamed png page: token-finding reports subsets smallest first, each subset is sent to
+        # analysis as soon as it is found, and each word-count group is rendered as soon as its
+        # analyses are done. emit() gets the page piece by piece and None once it is complete.
+        slots = asyncio.Semaphore(STREAM_ANALYZE_CONCURRENCY)
+        groups, analyses = [], []
+        try:
+            _, head = await self.call_stage("analysis-visualizer-service", ANALYSIS_VISUALIZER_URL,
+                                            b"{}", "application/json", dict(params, fragment="head"), VISUALIZE_TIMEOUT)
+            emit(head)
+
+            group_size = None
+            async for line in self.stream_lines("token-finding-service", TOKEN_FINDING_URL,
+                                                body, {"stream": "1"}, FIND_TIMEOUT):
+                found = json.loads(line)
+                if "error" in found:
+                    raise StageError("token-finding-service", 500)
+                # Subsets arrive size by size, so a larger one closes the current group
+                size = len(found["subset"].split())
+                if size != group_size and analyses:
+                    groups.append(asyncio.ensure_future(self.render_group(analyses, params)))
+                    analyses = []
+                group_size = size
+                analyses.append(asyncio.ensure_future(self.analyze_subset(found["subset"], found["ids"],
+                                                                          found_at(params, found.get("data_version")), slots)))
+            if analyses:
+                groups.append(asyncio.ensure_future(self.render_group(analyses, params)))
+
+            analyzed = {}
+            for group in groups:
+                group_analyzed, fragment = await group
+                analyzed.update(group_analyzed)
+                if fragment:
+                    emit(fragment)
+
+            _, summary = await self.call_stage("analysis-visualizer-service", ANALYSIS_VISUALIZER_URL,
+                                               json.dumps(analyzed).encode(), "application/json",
+                                               dict(params, fragment="summary"), VISUALIZE_TIMEOUT)
+            emit(summary)
+            return True
+        except (StageError, asyncio.TimeoutError, aiohttp.ClientError, ValueError) as e:
+            # The status line is long gone, so the failure is reported in the page itself
+            app.logger.info(f"Streamed request failed: {e!r}")
+            emit(b'<p class="text-danger">The analysis could not be completed.</p></body></html>')
+            return False
+        finally:
+            # On a failure, or when the client went away and this was cancelled, stop the analyses
+            # and renders still running rather than leave them calling the downstream services
+            pending = [task for task in groups + analyses if not task.done()]
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+            emit(None)
+
+
+_orchestrator = None
+_orchestrator_lock = threading.Lock()
+
+
+def get_orchestrator():
+    global _orchestrator
+    # Event loops and sockets don't survive a fork, so each worker process starts its own
+    with _orchestrator_lock:
+        if _orchestrator is None or _orchestrator.pid != os.getpid():
+            _orchestrator = Orchestrator()
+        return _orchestrator
+
+
+def stream_page(orchestrator, body, params, cache_key, version):
+    # Hand the page pieces from the orchestrator loop to the Flask response as they are produced,
+    # and cache the whole page once it completed successfully
+    chunks = queue.Queue()
+    future = asyncio.run_coroutine_threadsafe(orchestrator.stream(body, params, chunks.put), orchestrator.loop)
+    page = []
+    try:
+        while True:
+            chunk = chunks.get()
+            if chunk is None:
+                break
+            page.append(chunk)
+            yield chunk
+        if future.result() and version is not None:
+            result_cache.put(cache_key, version, "text/html; charset=utf-8", b"".join(page))
+    finally:
+        # Stop working for a client that went away
+        future.cancel()
+
 
 @app.route('/handle-request', methods=['POST'])
 def handle_requests():
     data = request.json
-    app.logger.info(data)
+    # Bucket size of the tweets-over-time histograms, computed by the analyzer and plotted as is
+    granularity = data.get("granularity", "month")
+    # Parameters of the analysis and visualization stages: the granularity and the optional
+    # [since, until) time window, which token-finding reads from the body
+    params = {"granularity": granularity}
+    params.update({name: str(data[name]) for name in ("since", "until") if data.get(name)})
+    # Output format: "png" (server-rendered images), "client" (drawn in the browser) or "json"
+    output_format = data.get("format", "png")
+    streamed = bool(data.get("stream")) and output_format == "png"
+
+    # Downstream stages get the normalized tokens, so every request sharing a cache key gets
+    # exactly the same response
+    data = dict(data, tokens=normalize_tokens(data.get("tokens", [])))
+    data.pop("stream", None)
+    body = json.dumps(data).encode()
+    # A streamed page and a buffered one are different responses, so they are cached apart
+    cache_key = ResultCache.key(dict(data, stream=streamed))
+    bypass = request.headers.get("X-Cache-Bypass", "").lower() in ("1", "true", "yes")
 
     try:
-        # Forward the request to the token-finding-service
-        response = requests.post('http://token-finding-service:3003/find-tweets', json=data)
-        if response.status_code != 200:
-            return jsonify({"error": "Failed to communicate with token-finding-service", "status_code": response.status_code}), response.status_code
-        app.logger.info(response.json())
-
-        # Forward the response to the tweet-analyzing-service
-        response = requests.post('http://tweet-analyzing-service:3004/analyze-tweets', json=response.json())
-        if response.status_code != 200:
-            return jsonify({"error": "Failed to communicate with tweet-analyzing-service", "status_code": response.status_code}), response.status_code
-        app.logger.info(response.json())
-
-        # Forward the response to the analysis-visualizer-service
-        response = requests.post('http://analysis-visualizer-service:3005/visualize', json=response.json())
-        if response.status_code == 200:
-            # Directly pass through the HTML response
-            return Response(response.content, mimetype='text/html')
+        orchestrator = get_orchestrator()
+        version = orchestrator.run(orchestrator.get_data_version())
+        if bypass:
+            # Recompute and refresh the cached copy
+            result_cache.record_bypass()
+            cache_status = "BYPASS"
+        elif version is not None:
+            cached = result_cache.get(cache_key, version)
+            if cached is not None:
+                RESULT_CACHE_REQUESTS.labels("HIT").inc()
+                content_type, content = cached
+                return Response(content, content_type=content_type, headers={"X-Cache": "HIT"})
+            cache_status = "MISS"
         else:
-            return jsonify({"error": "Failed to communicate with analysis-visualizer-service", "status_code": response.status_code}), response.status_code
+            cache_status = "DISABLED"
+        RESULT_CACHE_REQUESTS.labels(cache_status).inc()
+
+        if streamed:
+            # Send the top of the page right away and each group's charts as soon as they are ready
+            return Response(stream_page(orchestrator, body, params, cache_key, version),
+                            content_type="text/html; charset=utf-8",
+                            headers={"X-Accel-Buffering": "no", "X-Cache": cache_status})
+
+        def compute():
+            return orchestrator.run(orchestrator.handle(body, params, output_format))
 
-    except requests.exceptions.RequestException as e:
+        # A bypass asks for a fresh computation of its own (benchmarks measure the full
+        # pipeline with it), so it never joins one in flight
+        if bypass:
+            (content_type, content), shared = compute(), False
+        else:
+            (content_type, content), shared = requests_in_flight.do((cache_key, version), compute)
+        if shared:
+            COALESCED_REQUESTS.inc()
+        elif version is not None:
+            result_cache.put(cache_key, version, content_type, content)
+        # Directly pass through the HTML (or JSON) response
+        return Response(content, content_type=content_type, headers={"X-Cache": cache_status})
+    except StageError as e:
+        return jsonify({"error": f"Failed to communicate with {e.service}", "status_code": e.status_code}), e.status_code
+    except asyncio.TimeoutError as e:
+        print(e)
+        return jsonify({"error": "A downstream service timed out"}), 504
+    except aiohttp.ClientError as e:
         print(e)
         return jsonify({"error": "Network error occurred"}), 500
 
+
+@app.route('/cache-stats')
+def get_cache_stats():
+    return jsonify(dict(result_cache.stats(), in_flight=requests_in_flight.in_flight()))
+
+
 @app.route('/')
 def hello():
     return "Hello, I am the manager and I am up and running"
 
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0', port=3010)
-    
\ No newline at end of file
+    app.run(debug=os.getenv('FLASK_DEBUG') == '1', host='0.0.0.0', port=3010)
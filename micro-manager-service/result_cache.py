@@ -0,0 +1,130 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+def normalize_tokens(tokens):
+    # Token matching is case-insensitive and a repeated token adds nothing, so requests for the
+    # same set of tokens in any order and case produce the same result
+    return sorted({token.lower() for token in tokens})
+
+
+class ResultCache:
+    # Finished /handle-request responses keyed on the normalized request. Every entry remembers
+    # the data version it was computed against and is only served while that version is current
+    # and the entry is younger than `ttl` seconds. Entries live in memory under an LRU bound of
+    # `max_entries` and, when a directory is given, are also written to disk so they survive
+    # restarts and are shared by the workers of one container.
+
+    def __init__(self, max_entries, ttl, directory=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.directory = directory
+        self._entries = OrderedDict()  # key -> (data version, stored at, content type, content)
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "disk_hits": 0, "misses": 0, "stale": 0, "bypassed": 0, "evictions": 0}
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(request_body):
+        encoded = json.dumps(request_body, sort_keys=True, separators=(',', ':'), default=str)
+        return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+
+    def get(self, key, version):
+        # (content type, content) of a fresh entry computed against `version`, or None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if self._is_fresh(entry, version):
+                    self._entries.move_to_end(key)
+                    self._stats["hits"] += 1
+                    return entry[2], entry[3]
+                del self._entries[key]
+        entry = self._read_from_disk(key)
+        with self._lock:
+            if entry is None or not self._is_fresh(entry, version):
+                self._stats["stale" if entry is not None else "misses"] += 1
+                return None
+            self._stats["disk_hits"] += 1
+        self._remember(key, entry)
+        return entry[2], entry[3]
+
+    def put(self, key, version, content_type, content):
+        entry = (version, time.time(), content_type, content)
+        self._remember(key, entry)
+        self._write_to_disk(key, entry)
+
+    def record_bypass(self):
+        with self._lock:
+            self._stats["bypassed"] += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self._stats["hits"] + self._stats["disk_hits"] + self._stats["misses"] + self._stats["stale"]
+            hit_ratio = (self._stats["hits"] + self._stats["disk_hits"]) / lookups if lookups else 0.0
+            return dict(self._stats, entries=len(self._entries), max_entries=self.max_entries,
+                        ttl=self.ttl, hit_ratio=round(hit_ratio, 4))
+
+    def _is_fresh(self, entry, version):
+        return entry[0] == version and time.time() - entry[1] < self.ttl
+
+    def _remember(self, key, entry):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = entry
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._stats["evictions"] += 1
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".result")
+
+    def _read_from_disk(self, key):
+        # A JSON header line (version, stored at, content type) followed by the content
+        if not self.directory:
+            return None
+        try:
+            with open(self._path(key), 'rb') as f:
+                header = json.loads(f.readline())
+                content = f.read()
+        except (OSError, ValueError):
+            return None
+        return header["version"], header["stored_at"], header["content_type"], content
+
+    def _write_to_disk(self, key, entry):
+        if not self.directory:
+            return
+        version, stored_at, content_type, content = entry
+        header = json.dumps({"version": version, "stored_at": stored_at, "content_type": content_type})
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(header.encode('utf-8') + b"\n")
+                f.write(content)
+            os.replace(tmp_path, path)  # Atomic, readers never see a partial file
+        except OSError:
+            return
+        self._prune_disk()
+
+    def _prune_disk(self):
+        # Drop expired files, then the oldest ones beyond max_entries
+        now = time.time()
+        files = []
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if entry.name.endswith('.result'):
+                    files.append((entry.stat().st_mtime, entry.path))
+        files.sort(reverse=True)
+        for i, (mtime, path) in enumerate(files):
+            if i >= self.max_entries or now - mtime >= self.ttl:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
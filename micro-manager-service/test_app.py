@@ -0,0 +1,61 @@
+import asyncio
+import json
+
+from app import Orchestrator
+
+
+class FakeOrchestrator(Orchestrator):
+    # Token-finding reports two subsets and the analyzer finds no tweets for either, as for a
+    # time window that matches nothing; the visualizer fails on an empty group
+
+    def __init__(self):
+        self.fragments = []
+
+    async def stream_lines(self, service, url, body, params, timeout):
+        for subset in ("cats", "cats dogs"):
+            yield json.dumps({"subset": subset, "ids": [1, 2]}).encode()
+
+    async def call_stage(self, service, url, body, content_type, params, timeout, accept=None, response_headers=None):
+        if service == "tweet-analyzing-service":
+            return "application/json", b"{}"
+        self.fragments.append(params["fragment"])
+        assert params["fragment"] != "group" or json.loads(body), "empty group sent to the visualizer"
+        return "text/html", params["fragment"].encode()
+
+
+def test_stream_of_a_window_without_tweets():
+    orchestrator = FakeOrchestrator()
+    page = []
+    completed = asyncio.run(orchestrator.stream(b"{}", {"since": "2030-01-01"}, page.append))
+    assert completed
+    assert orchestrator.fragments == ["head", "summary"]
+    assert page == [b"head", b"summary", None]
+
+
+class HangingOrchestrator(FakeOrchestrator):
+    # The analyses never finish, so the client gives up while they run
+
+    def __init__(self):
+        super().__init__()
+        self.analyses = []
+
+    async def call_stage(self, service, url, body, content_type, params, timeout, accept=None, response_headers=None):
+        if service == "tweet-analyzing-service":
+            self.analyses.append(asyncio.current_task())
+            await asyncio.Event().wait()
+        return await super().call_stage(service, url, body, content_type, params, timeout, accept, response_headers)
+
+
+def test_cancelled_stream_stops_its_analyses():
+    async def cancel_while_analyzing():
+        orchestrator = HangingOrchestrator()
+        page = []
+        stream = asyncio.ensure_future(orchestrator.stream(b"{}", {}, page.append))
+        while len(orchestrator.analyses) < 2:
+            await asyncio.sleep(0)
+        stream.cancel()
+        await asyncio.gather(stream, return_exceptions=True)
+        assert all(task.done() for task in orchestrator.analyses)
+        assert page[-1] is None
+
+    asyncio.run(cancel_while_analyzing())
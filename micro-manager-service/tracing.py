@@ -0,0 +1,242 @@
+import contextvars
+import json
+import os
+import queue
+import random
+import threading
+import time
+import urllib.request
+from contextlib import contextmanager
+
+from flask import g, request
+
+# Spans are exported to TRACE_FILE (one JSON object per line) and/or POSTed in OTLP/HTTP JSON form
+# to TRACE_OTLP_ENDPOINT (e.g. http://otel-collector:4318/v1/traces). With neither set, trace ids
+# are still propagated but no span is recorded.
+TRACE_FILE = os.getenv("TRACE_FILE")
+TRACE_OTLP_ENDPOINT = os.getenv("TRACE_OTLP_ENDPOINT")
+SERVICE_NAME = os.getenv("SERVICE_NAME", "micro-manager-service")
+
+# Spans buffered for the exporter thread (beyond that they are dropped rather than slowing
+# requests down), and how many it sends at once
+TRACE_QUEUE_SIZE = int(os.getenv("TRACE_QUEUE_SIZE", "10000"))
+TRACE_BATCH_SIZE = int(os.getenv("TRACE_BATCH_SIZE", "256"))
+
+# OTLP span kinds
+INTERNAL, SERVER, CLIENT = 1, 2, 3
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+class Span:
+    def __init__(self, name, trace_id, parent_id=None, kind=INTERNAL, attributes=None, start_time=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = "%016x" % random.getrandbits(64)
+        self.parent_id = parent_id
+        self.kind = kind
+        self.attributes = dict(attributes or {})
+        self.start_time = time.time() if start_time is None else start_time
+        self.end_time = None
+        self.error = None
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def traceparent(self):
+        # W3C trace context header naming this span as the parent of the next hop
+        return f"00-{self.trace_id}-{self.span_id}-01"
+
+    def end(self, end_time=None):
+        if self.end_time is None:
+            self.end_time = time.time() if end_time is None else end_time
+            _exporter.export(self)
+
+
+def parse_traceparent(header):
+    # (trace id, parent span id) from a W3C traceparent header, or None when it is missing or malformed
+    parts = (header or "").strip().split("-")
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    try:
+        int(parts[1], 16), int(parts[2], 16)
+    except ValueError:
+        return None
+    return parts[1], parts[2]
+
+
+def current_span():
+    return _current_span.get()
+
+
+def start_span(name, kind=INTERNAL, parent=None, attributes=None, start_time=None):
+    # A span under `parent` (default: the current span), or the root of a new trace. It is not
+    # made current: use span() for that.
+    parent = parent or current_span()
+    if parent is None:
+        return Span(name, "%032x" % random.getrandbits(128), None, kind, attributes, start_time)
+    return Span(name, parent.trace_id, parent.span_id, kind, attributes, start_time)
+
+
+@contextmanager
+def span(name, kind=INTERNAL, **attributes):
+    # Time the block as a child of the current span, and make it the current span inside the block
+    new_span = start_span(name, kind, attributes=attributes)
+    token = _current_span.set(new_span)
+    try:
+        yield new_span
+    except Exception as e:
+        new_span.error = repr(e)
+        raise
+    finally:
+        _current_span.reset(token)
+        new_span.end()
+
+
+def outgoing_headers(parent=None):
+    # Headers carrying the trace to the next service
+    parent = parent or current_span()
+    return {"traceparent": parent.traceparent()} if parent is not None else {}
+
+
+def init_app(app):
+    # Continue the caller's trace (or start one) for every request, and tell the client its trace id
+
+    @app.before_request
+    def start_request_span():
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        incoming = parse_traceparent(request.headers.get("traceparent"))
+        attributes = {"http.method": request.method, "http.route": route}
+        if incoming is None:
+            g.trace_span = start_span(f"{request.method} {route}", SERVER, attributes=attributes)
+        else:
+            trace_id, parent_id = incoming
+            g.trace_span = Span(f"{request.method} {route}", trace_id, parent_id, SERVER, attributes)
+        g.trace_token = _current_span.set(g.trace_span)
+
+    @app.after_request
+    def add_trace_header(response):
+        request_span = g.get("trace_span")
+        if request_span is not None:
+            request_span.set_attribute("http.status_code", response.status_code)
+            response.headers["X-Trace-Id"] = request_span.trace_id
+        return response
+
+    @app.teardown_request
+    def end_request_span(error):
+        # Runs once the response is fully sent, so streamed responses are timed to their last byte
+        request_span = g.pop("trace_span", None)
+        if request_span is None:
+            return
+        if error is not None:
+            request_span.error = repr(error)
+        try:
+            _current_span.reset(g.pop("trace_token"))
+        except (KeyError, ValueError):
+            _current_span.set(None)
+        request_span.end()
+
+
+def to_otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+class SpanExporter:
+    # Ships finished spans from a background thread so exporting never blocks a request
+
+    def __init__(self):
+        self.enabled = bool(TRACE_FILE or TRACE_OTLP_ENDPOINT)
+        self.pid = None
+        self._queue = None
+        self._lock = threading.Lock()
+        self.dropped = 0
+
+    def export(self, finished_span):
+        if not self.enabled:
+            return
+        self._start()
+        try:
+            self._queue.put_nowait(finished_span)
+        except queue.Full:
+            self.dropped += 1
+
+    def _start(self):
+        # Threads don't survive a fork, so every worker process starts its own
+        if self.pid == os.getpid():
+            return
+        with self._lock:
+            if self.pid != os.getpid():
+                self._queue = queue.Queue(maxsize=TRACE_QUEUE_SIZE)
+                threading.Thread(target=self._run, args=(self._queue,), name="span-exporter", daemon=True).start()
+                self.pid = os.getpid()
+
+    def _run(self, span_queue):
+        while True:
+            batch = [span_queue.get()]
+            while len(batch) < TRACE_BATCH_SIZE:
+                try:
+                    batch.append(span_queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                if TRACE_FILE:
+                    self._write_file(batch)
+                if TRACE_OTLP_ENDPOINT:
+                    self._post_otlp(batch)
+            except Exception as e:
+                print(f"Could not export {len(batch)} spans: {e!r}")
+
+    @staticmethod
+    def _write_file(batch):
+        lines = []
+        for s in batch:
+            lines.append(json.dumps({
+                "service": SERVICE_NAME,
+                "trace_id": s.trace_id,
+                "span_id": s.span_id,
+                "parent_span_id": s.parent_id,
+                "name": s.name,
+                "kind": s.kind,
+                "start_time": s.start_time,
+                "duration_ms": round((s.end_time - s.start_time) * 1000, 3),
+                "attributes": s.attributes,
+                "error": s.error
+            }, default=str))
+        # One write per batch, so lines of concurrent workers don't interleave
+        with open(TRACE_FILE, 'a') as f:
+            f.write("\n".join(lines) + "\n")
+
+    @staticmethod
+    def _post_otlp(batch):
+        spans = []
+        for s in batch:
+            otlp_span = {
+                "traceId": s.trace_id,
+                "spanId": s.span_id,
+                "name": s.name,
+                "kind": s.kind,
+                "startTimeUnixNano": str(int(s.start_time * 1e9)),
+                "endTimeUnixNano": str(int(s.end_time * 1e9)),
+                "attributes": [{"key": key, "value": to_otlp_value(value)} for key, value in s.attributes.items()],
+                "status": {"code": 2, "message": s.error} if s.error else {"code": 1}
+            }
+            if s.parent_id:
+                otlp_span["parentSpanId"] = s.parent_id
+            spans.append(otlp_span)
+        body = json.dumps({"resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": SERVICE_NAME}}]},
+            "scopeSpans": [{"scope": {"name": "tweet-analyzer"}, "spans": spans}]
+        }]}).encode('utf-8')
+        otlp_request = urllib.request.Request(TRACE_OTLP_ENDPOINT, data=body,
+                                              headers={"Content-Type": "application/json"}, method="POST")
+        with urllib.request.urlopen(otlp_request, timeout=5) as response:
+            response.read()
+
+
+_exporter = SpanExporter()
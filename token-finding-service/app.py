@@ -1,68 +1,216 @@
+import json
 import os
 import psycopg2
-import itertools
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, stream_with_context
+from prometheus_client import Counter
+
+import idset
+import metrics
+import tracing
+from db import db_connection, pool_stats
+from metrics import db_query
+from singleflight import SingleFlight
+from subsets import evaluate_subsets, top_subsets
+from token_index import TokenIndex
+from window import parse_window, window_conditions
 
 app = Flask(__name__)
+metrics.init_app(app)
+tracing.init_app(app)
+
+# Matching engine: "index" answers subsets from the in-memory inverted index, "ilike" matches
+# substrings in the table (through the trigram index when there is one) and "fts" matches whole
+# words through the full-text GIN index
+TOKEN_ENGINE = os.getenv("TOKEN_ENGINE", "index")
+ENGINES = ("index", "ilike", "fts")
+
+# Must be the expression of database-feeding-service's tweets_content_fts_idx, or the index is not used
+CONTENT_TSVECTOR = "to_tsvector('simple', coalesce(content, ''))"
+# Limits on the subsets evaluated per request, 0 means unlimited; both can be overridden per request
+MAX_SUBSET_SIZE = int(os.getenv("MAX_SUBSET_SIZE", "0"))
+TOP_K_SUBSETS = int(os.getenv("TOP_K_SUBSETS", "0"))
+
+# Each worker caches the ids of the tokens it looked up with the index engine, at most this many
+# ids in all (8 bytes each), least recently used evicted first
+TOKEN_INDEX_CACHED_IDS = int(os.getenv("TOKEN_INDEX_CACHED_IDS", "5000000"))
+
+token_index = TokenIndex(TOKEN_INDEX_CACHED_IDS)
+
+# Requests looking up the same token (with the same engine, window and data version) at the same
+# time, like bursts of identical queries on a trending term, share one query. Subsets are intersections of
+# these lookups computed in memory, so this covers all of find's database work.
+lookups_in_flight = SingleFlight()
+COALESCED_LOOKUPS = Counter("token_lookups_coalesced_total",
+                            "Token lookups answered by another request's query in flight", ["engine"])
+
+
+def shared_lookup(engine, token, window, version, lookup):
+    # Matching is case-insensitive for both engines, so the key is too
+    ids, shared = lookups_in_flight.do((engine, token.lower(), window, version), lookup)
+    if shared:
+        COALESCED_LOOKUPS.labels(engine).inc()
+    return ids
+
 
-# Database connection details from environment variables
-DB_HOST = os.getenv("DB_HOST", "localhost")
-DB_NAME = os.getenv("DB_NAME", "postgres")
-DB_USER = os.getenv("DB_USER", "postgres")
+def lookup_ilike(token, cursor, window):
+    # Modified query to exclude tweets with author 'None'
+    conditions, params = window_conditions(window)
+    with db_query("lookup_ilike") as query:
+        cursor.execute("SELECT unique_id FROM tweets WHERE content ILIKE %s AND author <> 'None'" + conditions,
+                       [f"%{token}%"] + params)
+        ids = [item[0] for item in cursor.fetchall()]
+        query["rows"] = len(ids)
+    return ids
 
 
-def connect_to_db():
-    conn = psycopg2.connect(
-        dbname=DB_NAME,
-        user=DB_USER,
-        host=DB_HOST
-    )
-    return conn
+def lookup_fts(token, cursor, window):
+    # One GIN index scan per token (and partition in the window); subsets are then intersections
+    # of these posting lists
+    conditions, params = window_conditions(window)
+    with db_query("lookup_fts") as query:
+        cursor.execute(f"SELECT unique_id FROM tweets WHERE {CONTENT_TSVECTOR} @@ plainto_tsquery('simple', %s) "
+                       "AND author <> 'None'" + conditions, [token] + params)
+        ids = [item[0] for item in cursor.fetchall()]
+        query["rows"] = len(ids)
+    return ids
+
+
+def fallback_ilike(cursor, window):
+    conditions, params = window_conditions(window)
+    with db_query("fallback_ilike") as query:
+        cursor.execute("SELECT unique_id FROM tweets WHERE author = 'None'" + conditions, params)
+        ids = [item[0] for item in cursor.fetchall()]
+        query["rows"] = len(ids)
+    return ids
+
+
+def prepare_lookup(engine, conn, window):
+    # The engine's lookup function, and the data_version of the table its answers are exact for.
+    # The analyzer only answers a single word from its rollups for ids found at the rollups'
+    # version. None for fts, whose whole-word matches are not what the rollups count.
+    if engine == "index":
+        # Pick up any tweets inserted since the index was last refreshed. The index then holds
+        # every row up to its version; rows of later versions a concurrent refresh adds can only
+        # make the version reported stale, never wrong.
+        with db_query("token_index_refresh") as query:
+            indexed = query["rows"] = token_index.refresh(conn)
+        if indexed:
+            app.logger.info(f"Indexed {indexed} new tweets")
+        if window == (None, None):
+            return token_index.lookup, token_index.version
+        return lambda token: token_index.in_window(token_index.lookup(token), *window), token_index.version
+
+    # The version and every lookup read the same snapshot of the table
+    cursor = conn.cursor()
+    cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+    cursor.execute("SELECT version FROM data_version")
+    version = cursor.fetchone()[0]
+    if engine == "fts":
+        return lambda token: shared_lookup(engine, token, window, version, lambda: lookup_fts(token, cursor, window)), None
+    return lambda token: shared_lookup(engine, token, window, version, lambda: lookup_ilike(token, cursor, window)), version
+
+
+def iter_subset_results(tokens, engine, lookup, version, max_subset_size, top_k, conn, window):
+    # Yield (subset key, ids) for every reported subset, smallest subsets first
+    cursor = conn.cursor()
+
+    # Not made the current span: evaluation is suspended at every yield while the caller sends
+    # the results out, so the span covers evaluating and sending alike
+    evaluation = tracing.start_span("evaluate_subsets", attributes={"engine": engine, "tokens": len(tokens)})
+    results = evaluate_subsets(tokens, lookup, max_subset_size)
+    if top_k > 0:
+        # Ranking needs every subset evaluated first
+        results = top_subsets(list(results), top_k)
+
+    fallback = None
+    evaluated = 0
+    try:
+        for subset, ids in results:
+            evaluated += 1
+            if not ids:  # If no tweets found, fall back to the tweets with author 'None' (in the window)
+                if fallback is None:
+                    if engine == "index":
+                        fallback = token_index.fallback_ids()
+                        if window != (None, None):
+                            fallback = token_index.in_window(fallback, *window)
+                    else:
+                        fallback, _ = lookups_in_flight.do(("fallback", window, version), lambda: fallback_ilike(cursor, window))
+                yield " ".join(subset), fallback
+            else:
+                yield " ".join(subset), sorted(ids)
+    finally:
+        evaluation.set_attribute("subsets", evaluated)
+        evaluation.end()
+    app.logger.info(f"Reported {evaluated} subsets of {len(tokens)} tokens")
+
+
+def stream_subset_results(tokens, engine, max_subset_size, top_k, window):
+    # Newline-delimited JSON, one {"subset": key, "ids": [...], "data_version": version} line per
+    # subset as soon as it is evaluated, so callers can start on the small subsets while the large
+    # ones are computed
+    try:
+        with db_connection() as conn:
+            lookup, version = prepare_lookup(engine, conn, window)
+            for subset_key, ids in iter_subset_results(tokens, engine, lookup, version, max_subset_size, top_k, conn, window):
+                yield json.dumps({"subset": subset_key, "ids": ids, "data_version": version}) + "\n"
+    except (Exception, psycopg2.DatabaseError) as error:
+        print(error)
+        yield json.dumps({"error": str(error)}) + "\n"
+
+
+def parse_limit(body, name, default):
+    # A per-request subset limit: a non-negative integer (or its string), 0 meaning unlimited
+    value = body.get(name, default)
+    if isinstance(value, str) and value.strip().isdigit():
+        value = int(value)
+    if not isinstance(value, int) or isinstance(value, bool) or value < 0:
+        raise ValueError(f"{name} must be a non-negative integer, got {value!r}")
+    return value
 
 
 @app.route('/find-tweets', methods=['POST'])
 def find_tweets():
     retrieved_tweets = {}
     tokens = request.json['tokens']
-    conn = None
+    engine = request.json.get('engine', TOKEN_ENGINE)
+    if engine not in ENGINES:
+        return jsonify({"error": f"Unknown engine '{engine}'"}), 400
     try:
-        # Connect to the database
-        conn = connect_to_db()
-        cursor = conn.cursor()
-        
-        for r in range(1, len(tokens) + 1):
-            for subset in itertools.combinations(tokens, r):
-                app.logger.info(subset)
-                subset_key = " ".join(subset)
-                # Modified query to exclude tweets with author 'None'
-                query = "SELECT unique_id FROM tweets WHERE " + \
-                        " AND ".join(["content ILIKE %s" for _ in subset]) + \
-                        " AND author <> 'None'"
-                cursor.execute(query, tuple(f"%{token}%" for token in subset))
-                result = cursor.fetchall()
-
-                if not result:  # If no tweets found, try fetching a tweet with author 'None'
-                    fallback_query = "SELECT unique_id FROM tweets WHERE " + \
-                                     "author = 'None'"
-                    cursor.execute(fallback_query, tuple(f"%{token}%" for token in subset))
-                    result = cursor.fetchall()
-    
-                app.logger.info(result)
-
-                flat_result = [item[0] for item in result]
-                
-                app.logger.info(flat_result)
-
-                retrieved_tweets[subset_key] = flat_result
-        
+        max_subset_size = parse_limit(request.json, 'max_subset_size', MAX_SUBSET_SIZE)
+        top_k = parse_limit(request.json, 'top_k', TOP_K_SUBSETS)
+        # Optional time window, only tweets dated inside it are matched
+        window = parse_window(request.json)
+    except ValueError as error:
+        return jsonify({"error": str(error)}), 400
+
+    if request.args.get('stream'):
+        return Response(stream_with_context(stream_subset_results(tokens, engine, max_subset_size, top_k, window)),
+                        mimetype='application/x-ndjson')
+
+    try:
+        # Borrow a pooled connection to the database
+        with db_connection() as conn:
+            lookup, version = prepare_lookup(engine, conn, window)
+            for subset_key, ids in iter_subset_results(tokens, engine, lookup, version, max_subset_size, top_k, conn, window):
+                retrieved_tweets[subset_key] = ids
+
     except (Exception, psycopg2.DatabaseError) as error:
         print(error)
         return jsonify({"error": str(error)}), 500
-    finally:
-        if conn is not None:
-            conn.close()
-            
-    return jsonify(retrieved_tweets)
+
+    if idset.CONTENT_TYPE in request.headers.get("Accept", ""):
+        response = Response(idset.encode_id_sets(retrieved_tweets), mimetype=idset.CONTENT_TYPE)
+    else:
+        response = jsonify(retrieved_tweets)
+    # The data version the ids are exact for, see prepare_lookup
+    if version is not None:
+        response.headers["X-Data-Version"] = str(version)
+    return response
+
+
+@app.route('/pool-stats')
+def get_pool_stats():
+    return jsonify(pool_stats())
 
 
 @app.route('/')
@@ -71,5 +219,5 @@ def hello():
 
 
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0', port=3003)
+    app.run(debug=os.getenv('FLASK_DEBUG') == '1', host='0.0.0.0', port=3003)
     
\ No newline at end of file
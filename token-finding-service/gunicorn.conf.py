@@ -0,0 +1,38 @@
+import os
+import shutil
+
+# Production server settings, used as `gunicorn --config gunicorn.conf.py app:app`. Each one can
+# be overridden from the environment.
+bind = f"0.0.0.0:{os.getenv('PORT', '3003')}"
+# Every worker builds and keeps current its own token index (postings, vocabulary grams, per-tweet
+# times: several times the size of the content column), so memory grows with the number of
+# workers. Few workers with more threads each, rather than one per CPU; scale out with replicas.
+workers = int(os.getenv("GUNICORN_WORKERS", "2"))
+worker_class = "gthread"
+threads = int(os.getenv("GUNICORN_THREADS", "8"))
+# Seconds an idle keep-alive connection stays open, a silent worker lives, and in-flight requests
+# get to finish on shutdown (SIGTERM)
+keepalive = int(os.getenv("GUNICORN_KEEPALIVE", "5"))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "60"))
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", "30"))
+accesslog = "-"
+
+
+def worker_exit(server, worker):
+    # Close the worker's pooled database connections rather than leaving them for the server to drop
+    from db import close_pool
+    close_pool()
+
+
+def on_starting(server):
+    # Workers write their metrics to PROMETHEUS_MULTIPROC_DIR; start from an empty one so the
+    # samples of a previous run aren't added to this one's
+    directory = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+    if directory:
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory)
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,47 @@
+import threading
+
+
+class SingleFlight:
+    # Coalesces concurrent calls for the same key: the first caller runs the function and the
+    # callers arriving while it runs wait for it and get its result, or its exception. Nothing
+    # is kept once the call completed, so unlike a cache a later call runs the function again.
+    # Works across the threads of one process.
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}  # key -> _Call in flight
+
+    def do(self, key, function):
+        # (result, shared), shared being True for the callers that waited on another one's call
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+        try:
+            call.result = function()
+        except BaseException as error:
+            call.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result, False
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._calls)
+
+
+class _Call:
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
@@ -0,0 +1,37 @@
+import heapq
+import itertools
+
+
+def evaluate_subsets(tokens, lookup, max_size=0):
+    # Yield (subset, ids) for the token subsets in itertools.combinations order, size by size.
+    # Each subset is the intersection of its prefix (evaluated in the previous round) with
+    # its last token, so every token is looked up exactly once. A subset is only evaluated
+    # when all of its subsets one token smaller matched something: the supersets of an
+    # empty subset are empty too, so they are skipped and never yielded.
+    max_size = len(tokens) if max_size <= 0 else min(max_size, len(tokens))
+    singles = {}
+    previous = {}
+    for r in range(1, max_size + 1):
+        current = {}
+        for positions in itertools.combinations(range(len(tokens)), r):
+            if r == 1:
+                ids = singles[positions[0]] = set(lookup(tokens[positions[0]]))
+            else:
+                if any(positions[:i] + positions[i + 1:] not in previous for i in range(r)):
+                    continue
+                ids = previous[positions[:-1]] & singles[positions[-1]]
+            if ids:
+                current[positions] = ids
+            yield tuple(tokens[i] for i in positions), ids
+        if not current:
+            break
+        previous = current
+
+
+def top_subsets(results, k):
+    # Keep the k subsets with the most matches (ties go to the larger, then earlier, subset),
+    # preserving the evaluation order of the ones kept
+    if k <= 0 or len(results) <= k:
+        return results
+    ranked = heapq.nsmallest(k, range(len(results)), key=lambda i: (-len(results[i][1]), -len(results[i][0]), i))
+    return [results[i] for i in sorted(ranked)]
@@ -0,0 +1,9 @@
+from app import app
+
+
+def test_invalid_subset_limits_are_rejected():
+    client = app.test_client()
+    for body in ({"max_subset_size": "two"}, {"top_k": -1}, {"top_k": [3]}, {"max_subset_size": None}):
+        response = client.post("/find-tweets", json=dict(body, tokens=["cats"]))
+        assert response.status_code == 400
+        assert "must be a non-negative integer" in response.get_json()["error"]
@@ -0,0 +1,199 @@
+import threading
+from array import array
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+EPOCH = datetime(1970, 1, 1)
+# Time of the tweets without a date, and of the unique_ids no tweet has
+NO_TIME = -2 ** 63
+# Rows fetched from the database and indexed at a time; lookups wait for one batch at most
+REFRESH_BATCH = 10000
+# A refresh adding postings to more words than this clears the cached lookups instead of
+# picking out the ones those words change
+INVALIDATE_WORDS = 1000
+
+# Rows of the unique_id ranges database-feeding logged for the data versions in (%s, %s]
+CHANGED_ROWS_SQL = """
+SELECT t.unique_id, t.author, t.content, t.date_time
+FROM tweet_changes c JOIN tweets t ON t.unique_id BETWEEN c.first_id AND c.last_id
+WHERE c.version > %s AND c.version <= %s
+"""
+
+
+def seconds(date_time):
+    return (date_time - EPOCH) // timedelta(seconds=1)
+
+
+def grams(word):
+    # The 2 and 3 character substrings of a word
+    return {word[start:start + size] for size in (2, 3) for start in range(len(word) - size + 1)}
+
+
+def substrings(word):
+    return {word[start:end] for start in range(len(word)) for end in range(start + 1, len(word) + 1)}
+
+
+class TokenIndex:
+    # In-memory inverted index over tweets.content: word -> list of unique_id.
+    # Words are the whitespace separated chunks of the lower-cased content, so a query
+    # token (which never contains whitespace) matches exactly the tweets that
+    # "content ILIKE '%token%'" would match. The vocabulary is itself indexed by its 2 and 3
+    # character substrings, so finding the words containing a token only looks at words sharing
+    # all of its trigrams rather than at every word. Each process holds its own copy, see
+    # gunicorn.conf.py for what that means for the worker count.
+
+    def __init__(self, max_cached_ids):
+        self._lock = threading.Lock()  # Guards the index, held for one batch or lookup at a time
+        self._refresh_lock = threading.Lock()  # One refresh at a time
+        self._postings = {}
+        self._grams = {}  # 2 or 3 character substring -> words of _postings containing it
+        self._fallback_ids = []  # Tweets whose author is 'None', kept out of the postings
+        self._version = None  # data_version indexed so far
+        self._indexed = bytearray()  # unique_id -> 1 once indexed
+        self._times = array('q')  # unique_id -> date_time in seconds since EPOCH, for time windows
+        # Query token -> matching ids, least recently used first, dropped when a word containing it
+        # gets new postings. Holds at most max_cached_ids ids in all.
+        self._lookups = OrderedDict()
+        self._max_cached_ids = max_cached_ids
+        self._cached_ids = 0
+        self._generation = 0  # Bumped by every batch, so a lookup computed across one isn't cached
+
+    def refresh(self, conn):
+        # Index the rows added since the data version last indexed. unique_ids are handed out
+        # before commit, so concurrent writers commit them out of order and no unique_id watermark
+        # can tell which rows are new; database-feeding logs the unique_id range of every version
+        # in tweet_changes instead. The first refresh, or one the log no longer reaches back for,
+        # reads the whole table. Rows read again (upserts, overlapping ranges) are skipped.
+        with self._refresh_lock:
+            cursor = conn.cursor()
+            cursor.execute("SELECT version FROM data_version")
+            version = cursor.fetchone()[0]
+            if version == self._version:
+                cursor.close()
+                return 0
+            cursor.execute("SELECT min(version) FROM tweet_changes")
+            oldest = cursor.fetchone()[0]
+            cursor.close()
+
+            # Server-side cursor so the initial build streams the table instead of loading it whole
+            cursor = conn.cursor(name="token_index_refresh")
+            cursor.itersize = REFRESH_BATCH
+            if self._version is not None and oldest is not None and self._version >= oldest - 1:
+                cursor.execute(CHANGED_ROWS_SQL, (self._version, version))
+            else:
+                cursor.execute("SELECT unique_id, author, content, date_time FROM tweets")
+            indexed = 0
+            while True:
+                rows = cursor.fetchmany(REFRESH_BATCH)
+                if not rows:
+                    break
+                with self._lock:
+                    indexed += self._add(rows)
+            cursor.close()
+            self._version = version
+            return indexed
+
+    def _add(self, rows):
+        indexed = 0
+        touched = set()  # Words given new postings
+        for unique_id, author, content, date_time in rows:
+            if len(self._indexed) <= unique_id:
+                self._indexed.extend(bytes(unique_id + 1 - len(self._indexed)))
+                self._times.extend([NO_TIME] * (unique_id + 1 - len(self._times)))
+            elif self._indexed[unique_id]:
+                continue
+            self._indexed[unique_id] = 1
+            indexed += 1
+            self._times[unique_id] = NO_TIME if date_time is None else seconds(date_time)
+            if author is None:
+                # Like in the other engines' SQL, where neither author <> 'None' nor author = 'None'
+                # holds for NULL: never matched, and not a fallback tweet either
+                continue
+            if author == 'None':
+                self._fallback_ids.append(unique_id)
+                continue
+            for word in set((content or "").lower().split()):
+                postings = self._postings.get(word)
+                if postings is None:
+                    postings = self._postings[word] = []
+                    for gram in grams(word):
+                        self._grams.setdefault(gram, set()).add(word)
+                postings.append(unique_id)
+                touched.add(word)
+        self._generation += 1
+        if len(touched) > INVALIDATE_WORDS:
+            self._lookups.clear()
+            self._cached_ids = 0
+        elif self._lookups:
+            for word in touched:
+                for token in substrings(word):
+                    self._forget(token)
+        return indexed
+
+    def _forget(self, token):
+        ids = self._lookups.pop(token, None)
+        if ids is not None:
+            self._cached_ids -= len(ids)
+
+    def _remember(self, token, ids):
+        # Cache a lookup, evicting the least recently used ones over the budget. A lookup larger
+        # than the whole budget (a very common short token) is not cached at all.
+        if len(ids) > self._max_cached_ids:
+            return
+        self._forget(token)
+        self._lookups[token] = ids
+        self._cached_ids += len(ids)
+        while self._cached_ids > self._max_cached_ids:
+            _, evicted = self._lookups.popitem(last=False)
+            self._cached_ids -= len(evicted)
+
+    def _words_containing(self, token):
+        # The indexed words containing the token, None for a single character (no gram to narrow by)
+        if len(token) >= 3:
+            candidates = sorted((self._grams.get(token[start:start + 3], set()) for start in range(len(token) - 2)), key=len)
+            return [word for word in candidates[0].intersection(*candidates[1:]) if token in word]
+        if len(token) == 2:
+            return list(self._grams.get(token, ()))
+        return None
+
+    def lookup(self, token):
+        # Union of the posting lists of every indexed word containing the token
+        token = token.lower()
+        with self._lock:
+            ids = self._lookups.get(token)
+            if ids is not None:
+                self._lookups.move_to_end(token)
+                return ids
+            generation = self._generation
+            words = self._words_containing(token)
+            if words is None:
+                vocabulary = list(self._postings)
+        if words is None:
+            # Scan the vocabulary without holding up refreshes and other lookups
+            words = [word for word in vocabulary if token in word]
+        with self._lock:
+            matches = set()
+            for word in words:
+                matches.update(self._postings[word])
+            ids = sorted(matches)
+            if generation == self._generation:
+                self._remember(token, ids)
+            return ids
+
+    @property
+    def version(self):
+        # data_version of the last refresh; the index holds every row up to it
+        return self._version
+
+    def in_window(self, ids, since, until):
+        # The ids whose tweet's date_time is in [since, until), either bound may be None.
+        # Like the SQL conditions, a window with any bound leaves out the tweets without a date.
+        low = NO_TIME + 1 if since is None else seconds(since)
+        high = 2 ** 63 - 1 if until is None else seconds(until)
+        with self._lock:
+            times = self._times
+            return [unique_id for unique_id in ids if low <= times[unique_id] < high]
+
+    def fallback_ids(self):
+        with self._lock:
+            return sorted(self._fallback_ids)
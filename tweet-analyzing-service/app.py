@@ -1,96 +1,298 @@
 import os
+from collections import Counter
+from datetime import date, timedelta
 import psycopg2
 from flask import Flask, request, jsonify
 
+import columnar
+import idset
+import metrics
+import tracing
+from db import db_connection, pool_stats
+from metrics import db_query
+from window import parse_window, window_conditions
+
 app = Flask(__name__)
+metrics.init_app(app)
+tracing.init_app(app)
+
+# Where the statistics are computed: "columnar" gathers from the memory-mapped snapshot (see
+# columnar.py) and falls back to "python" while it is out of date, "python" fetches the tweets,
+# "sql" aggregates in the database. Can be overridden per request with ?mode=
+ANALYZE_MODE = os.getenv("ANALYZE_MODE", "columnar")
+MODES = ("columnar", "python", "sql")
+
+# Bucket sizes the tweet histograms can be requested at (?granularity=), named as date_trunc fields
+GRANULARITIES = ("day", "week", "month", "year")
+
+# Whether keys that are one rollup token are answered from database-feeding's per-month rollups
+# instead of the tweets themselves. Can be overridden per request with ?rollups=0 or 1. Only
+# requests whose ids token-finding found at a known data version (?found_at=) can use them.
+USE_ROLLUPS = os.getenv("USE_ROLLUPS", "1") == "1"
+# The rollups are monthly, finer histograms need the tweets
+ROLLUP_GRANULARITIES = ("month", "year")
+# Month the rollups file the tweets without a date under
+ROLLUP_NO_DATE = date(1, 1, 1)
+
+# The rollups are kept in the transactions that change tweets, so with data_version read in the
+# same statement they describe the table as of that version
+ROLLUP_SQL = """
+SELECT r.token, r.month, r.tweet_count, r.like_sum, r.share_sum, r.max_likes, r.max_likes_id, r.max_shares, r.max_shares_id,
+       v.version
+FROM token_rollups r JOIN rollup_tokens t ON t.token = r.token CROSS JOIN data_version v
+WHERE t.ready AND r.token = ANY(%s)
+ORDER BY r.token, r.month
+"""
+
+# Per-token statistics in one grouped query: the request is unnested into (token, unique_id)
+# pairs, joined against tweets and reduced to a handful of numbers plus a time histogram. {window}
+# takes the request's time window conditions, which keep the join to the partitions in it.
+AGGREGATE_SQL = """
+WITH requested AS (
+    SELECT * FROM unnest(%s::text[], %s::int[]) AS r(token, unique_id)
+), matched AS (
+    SELECT r.token, t.unique_id, t.number_of_likes, t.number_of_shares, t.date_time
+    FROM requested r JOIN tweets t ON t.unique_id = r.unique_id{window}
+), buckets AS (
+    SELECT token, date_trunc(%s, date_time) AS bucket, count(*) AS tweets
+    FROM matched
+    WHERE date_time IS NOT NULL
+    GROUP BY token, bucket
+)
+SELECT m.token,
+       count(*),
+       avg(m.number_of_likes)::float8,
+       (array_agg(m.unique_id ORDER BY m.number_of_likes DESC NULLS LAST, m.unique_id))[1],
+       avg(m.number_of_shares)::float8,
+       (array_agg(m.unique_id ORDER BY m.number_of_shares DESC NULLS LAST, m.unique_id))[1],
+       (SELECT json_agg(json_build_array(to_char(b.bucket, 'YYYY-MM-DD'), b.tweets) ORDER BY b.bucket)
+        FROM buckets b WHERE b.token = m.token)
+FROM matched m
+GROUP BY m.token
+"""
+
+
+def get_tweet_stats_from_db(tweet_ids, conn, window):
+    # Fetch the columns the statistics need for every requested tweet in one round trip.
+    # A server-side cursor streams the result so huge id sets don't land in memory at once.
+    tweets = {}
+    conditions, params = window_conditions(window)
+    with db_query("tweet_stats") as query:
+        cursor = conn.cursor(name="tweet_stats")
+        cursor.itersize = 10000
+        cursor.execute(
+            "SELECT unique_id, number_of_likes, number_of_shares, date_time FROM tweets WHERE unique_id = ANY(%s)"
+            + conditions,
+            [list(tweet_ids)] + params
+        )
+        for unique_id, number_of_likes, number_of_shares, date_time in cursor:
+            tweets[unique_id] = {
+                "unique_id": unique_id,
+                "number_of_likes": number_of_likes,
+                "number_of_shares": number_of_shares,
+                "date_time": date_time
+            }
+        cursor.close()
+        query["rows"] = len(tweets)
+    return tweets
+
+
+def bucket_start(date_time, granularity):
+    # Python equivalent of date_trunc(granularity, date_time), as an ISO date
+    day = date_time.date()
+    if granularity == "week":
+        day -= timedelta(days=day.weekday())
+    elif granularity == "month":
+        day = day.replace(day=1)
+    elif granularity == "year":
+        day = day.replace(month=1, day=1)
+    return day.isoformat()
+
+
+def build_histogram(tweets, granularity):
+    # Compact [[bucket_start, count], ...] series, sorted by bucket
+    counts = Counter(bucket_start(tweet['date_time'], granularity) for tweet in tweets if tweet['date_time'] is not None)
+    return [[bucket, count] for bucket, count in sorted(counts.items())]
+
+
+def aggregate_tweets_in_db(data, conn, granularity, window):
+    tokens = []
+    tweet_ids = []
+    for token, ids in data.items():
+        tokens.extend([token] * len(ids))
+        tweet_ids.extend(ids)
+
+    with db_query("aggregate_tweets") as query:
+        cursor = conn.cursor()
+        conditions, params = window_conditions(window, "t.date_time")
+        cursor.execute(AGGREGATE_SQL.format(window=conditions), [tokens, tweet_ids] + params + [granularity])
+        rows = cursor.fetchall()
+        cursor.close()
+        query["rows"] = len(rows)
+
+    insights = {}
+    for token, total_tweets, avg_likes, max_likes_id, avg_shares, max_shares_id, histogram in rows:
+        insights[token] = {
+            "total_number_of_tweets": total_tweets,
+            "tweet_with_highest_number_of_likes": max_likes_id,
+            "average_number_of_likes": avg_likes,
+            "tweet_with_highest_number_of_shares": max_shares_id,
+            "average_number_of_shares": avg_shares,
+            "tweet_histogram": histogram or []
+        }
+    # Keep the request's token order
+    return {token: insights[token] for token in data if token in insights}
 
-# Database connection details from environment variables
-DB_HOST = os.getenv("DB_HOST", "localhost")
-DB_NAME = os.getenv("DB_NAME", "postgres")
-DB_USER = os.getenv("DB_USER", "postgres")
 
+def analyze_from_rollups(data, conn, granularity, found_at):
+    # Answer the keys that are a single word with rollups, in O(months) instead of O(matches).
+    # The rollups count the tweets whose content contains the word, which is what token-finding's
+    # substring engines return for it. When token-finding found the ids at the version the rollups
+    # are at, a key's ids are therefore exactly the rolled up tweets; a word without rollup rows
+    # had no match and got the fallback tweets, which are left to the caller, as is everything
+    # when the versions differ. ASCII only, where Python's and Postgres' lower() agree.
+    if granularity not in ROLLUP_GRANULARITIES or found_at is None:
+        return {}
+    tokens = {key: key.lower() for key, ids in data.items() if len(ids) and key.isascii() and key.isalnum()}
+    if not tokens:
+        return {}
+    with db_query("token_rollups") as query:
+        cursor = conn.cursor()
+        cursor.execute(ROLLUP_SQL, (sorted(set(tokens.values())),))
+        rows = cursor.fetchall()
+        cursor.close()
+        query["rows"] = len(rows)
+    if not rows or rows[0][-1] != found_at:
+        return {}
+    months = {}
+    for row in rows:
+        months.setdefault(row[0], []).append(row[1:-1])
+
+    insights = {}
+    for key, token in tokens.items():
+        rollups = months.get(token)
+        if not rollups:
+            continue
+        total_tweets = sum(rollup[1] for rollup in rollups)
+        # Most liked and shared across the months, ties to the lowest unique_id like max() over sorted ids
+        max_likes = min((rollup for rollup in rollups if rollup[4] is not None), key=lambda x: (-x[4], x[5]), default=None)
+        max_shares = min((rollup for rollup in rollups if rollup[6] is not None), key=lambda x: (-x[6], x[7]), default=None)
+        histogram = Counter()
+        for month, tweet_count, *_ in rollups:
+            if month != ROLLUP_NO_DATE:
+                histogram[month.replace(month=1) if granularity == "year" else month] += tweet_count
+        insights[key] = {
+            "total_number_of_tweets": total_tweets,
+            "tweet_with_highest_number_of_likes": max_likes[5] if max_likes else None,
+            "average_number_of_likes": sum(rollup[2] for rollup in rollups) / total_tweets,
+            "tweet_with_highest_number_of_shares": max_shares[7] if max_shares else None,
+            "average_number_of_shares": sum(rollup[3] for rollup in rollups) / total_tweets,
+            "tweet_histogram": [[bucket.isoformat(), count] for bucket, count in sorted(histogram.items())]
+        }
+    return insights
+
+
+def get_data_version(conn):
+    with db_query("data_version") as query:
+        cursor = conn.cursor()
+        cursor.execute("SELECT version FROM data_version")
+        row = cursor.fetchone()
+        cursor.close()
+        query["rows"] = 1 if row else 0
+    return row[0] if row else 0
+
+
+def analyze_tweets_in_python(data, conn, granularity, window):
+    insights = {}
+
+    # One bulk fetch shared by every token, subsets overlap heavily
+    all_tweet_ids = set()
+    for tweet_ids in data.values():
+        all_tweet_ids.update(tweet_ids)
+    tweets = get_tweet_stats_from_db(all_tweet_ids, conn, window)
 
-def connect_to_db():
-    conn = psycopg2.connect(
-        dbname=DB_NAME,
-        user=DB_USER,
-        host=DB_HOST
-    )
-    return conn
+    for token, tweet_ids in data.items():
+        current_tweets = [tweets[tweet_id] for tweet_id in tweet_ids if tweet_id in tweets]
+        # None of its tweets are in the window (or still exist), like the sql path leave it out
+        if not current_tweets:
+            continue
 
+        total_tweets = len(current_tweets)
 
-def get_tweet_from_db(tweet_id, cur):
-    # Function to retrieve a tweet from the database by ID
-    cur.execute("SELECT * FROM tweets WHERE unique_id = %s", (tweet_id,))
-    tweet = cur.fetchone()
-    return tweet
+        # Tweet with the highest number of likes and average number of likes
+        max_likes = max(current_tweets, key=lambda x: x['number_of_likes'])
+        avg_likes = sum(tweet['number_of_likes'] for tweet in current_tweets) / total_tweets
+
+        # Tweet with the highest number of shares and average number of shares
+        max_shares = max(current_tweets, key=lambda x: x['number_of_shares'])
+        avg_shares = sum(tweet['number_of_shares'] for tweet in current_tweets) / total_tweets
+
+        # Compile insights for the token
+        insights[token] = {
+            "total_number_of_tweets": total_tweets,
+            "tweet_with_highest_number_of_likes": max_likes['unique_id'],
+            "average_number_of_likes": avg_likes,
+            "tweet_with_highest_number_of_shares": max_shares['unique_id'],
+            "average_number_of_shares": avg_shares,
+            "tweet_histogram": build_histogram(current_tweets, granularity)
+        }
+
+    return insights
 
 
 @app.route('/analyze-tweets', methods=['POST'])
 def analyze_tweets():
-    data = request.json
-    insights = {}
-    conn = None
+    mode = request.args.get('mode', ANALYZE_MODE)
+    granularity = request.args.get('granularity', "month")
+    use_rollups = request.args.get('rollups', "1" if USE_ROLLUPS else "0") == "1"
+    found_at = request.args.get('found_at', type=int)
+    if mode not in MODES:
+        return jsonify({"error": f"Unknown mode '{mode}'"}), 400
+    if granularity not in GRANULARITIES:
+        return jsonify({"error": f"Unknown granularity '{granularity}'"}), 400
     try:
-        conn = connect_to_db()
-        cursor = conn.cursor()
-        
-        for token, tweet_ids in data.items():
-            tweets = {}
-            current_tweets = []
-            for tweet_id in tweet_ids:
-                if tweet_id not in tweets:
-                    tweet = get_tweet_from_db(tweet_id, cursor)
-                    if tweet:
-                        tweet_dict = {
-                            "unique_id": tweet[0],
-                            "author": tweet[1],
-                            "content": tweet[2],
-                            "country": tweet[3],
-                            "date_time": tweet[4],
-                            "id": tweet[5],
-                            "language": tweet[6],
-                            "latitude": tweet[7],
-                            "longitude": tweet[8],
-                            "number_of_likes": tweet[9],
-                            "number_of_shares": tweet[10]
-                        }
-                        tweets[tweet_id] = tweet_dict
-                        current_tweets.append(tweet_dict)
+        # Every path keeps only the tweets inside the window, whatever ids were sent. The rollups
+        # cover all time, so they are not used with one.
+        window = parse_window(request.args)
+    except ValueError as error:
+        return jsonify({"error": str(error)}), 400
+    if window != (None, None):
+        use_rollups = False
+    # Id sets come as JSON or, from the manager, in the compact binary format
+    if request.mimetype == idset.CONTENT_TYPE and mode == "columnar":
+        data = columnar.decode_id_arrays(request.get_data())
+    elif request.mimetype == idset.CONTENT_TYPE:
+        data = idset.decode_id_sets(request.get_data())
+    else:
+        data = request.json
+    try:
+        with db_connection() as conn:
+            insights = analyze_from_rollups(data, conn, granularity, found_at) if use_rollups else {}
+            remaining = {token: ids for token, ids in data.items() if token not in insights}
+            if remaining and mode == "columnar":
+                snapshot = columnar.get_snapshot(get_data_version(conn))
+                if snapshot is not None:
+                    insights.update(columnar.analyze(remaining, snapshot, granularity, window))
+                    remaining = {}
                 else:
-                    current_tweets.append(tweets[tweet_id])
-                    
-            app.logger.info("Starting to analyze " + token)
-            total_tweets = len(current_tweets)
-
-            # Tweet with the highest number of likes and average number of likes
-            max_likes = max(current_tweets, key=lambda x: x['number_of_likes'])
-            avg_likes = sum(tweet['number_of_likes'] for tweet in current_tweets) / total_tweets
-
-            # Tweet with the highest number of shares and average number of shares
-            max_shares = max(current_tweets, key=lambda x: x['number_of_shares'])
-            avg_shares = sum(tweet['number_of_shares'] for tweet in current_tweets) / total_tweets
-
-            # Compile insights for the token
-            insights[token] = {
-                "total_number_of_tweets": total_tweets,
-                "tweet_with_highest_number_of_likes": max_likes['unique_id'],
-                "average_number_of_likes": avg_likes,
-                "tweet_with_highest_number_of_shares": max_shares['unique_id'],
-                "average_number_of_shares": avg_shares,
-                "tweet_datetimes": [tweet['date_time'] for tweet in current_tweets]
-            }
+                    # No snapshot of the current data yet, one is being built
+                    remaining = {token: [int(tweet_id) for tweet_id in ids] for token, ids in remaining.items()}
+            if remaining and mode == "sql":
+                insights.update(aggregate_tweets_in_db(remaining, conn, granularity, window))
+            elif remaining:
+                insights.update(analyze_tweets_in_python(remaining, conn, granularity, window))
 
-            current_tweets.clear()
+        # Keep the request's token order
+        return jsonify({token: insights[token] for token in data if token in insights})
 
-        return jsonify(insights)
-    
     except (Exception, psycopg2.DatabaseError) as error:
         print(error)
         return jsonify({"error": "Internal server error", "details": str(error)}), 500
-    finally:
-        if conn is not None:
-            conn.close()
+
+
+@app.route('/pool-stats')
+def get_pool_stats():
+    return jsonify(pool_stats())
 
 
 @app.route('/')
@@ -99,5 +301,5 @@ def hello():
 
 
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0', port=3004)
+    app.run(debug=os.getenv('FLASK_DEBUG') == '1', host='0.0.0.0', port=3004)
     
\ No newline at end of file
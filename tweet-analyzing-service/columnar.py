@@ -0,0 +1,271 @@
+import fcntl
+import os
+import shutil
+import tempfile
+import threading
+import time
+import zlib
+from datetime import datetime, timedelta
+
+import msgpack
+import numpy as np
+
+from db import db_connection
+from metrics import db_query
+
+# Columnar snapshot of the tweet columns the statistics need: one .npy file per column, indexed
+# by unique_id, that every worker memory maps read-only so they all share one copy in the page
+# cache. A snapshot holds the table as of one data_version. When the table has moved on, one
+# worker (whichever gets the lock file) brings it up to date in the background into a new
+# directory, renames that into place and points CURRENT at it; until then requests are served
+# from the table.
+SNAPSHOT_DIR = os.getenv("SNAPSHOT_DIR", "/tmp/tweet-snapshot")
+FETCH_ROWS = 10000
+# Times a worker re-reads CURRENT when the snapshot it names is deleted before it is mapped
+MAP_ATTEMPTS = 3
+# Bumped whenever the columns change, snapshots of another format are rebuilt rather than mapped
+FORMAT = 2
+
+EPOCH = datetime(1970, 1, 1)
+# Seconds since EPOCH of the tweets without a date
+NO_TIME = np.iinfo(np.int64).min
+COLUMNS = {
+    "present": np.bool_,  # False where no tweet has that unique_id
+    "likes": np.int32,
+    "shares": np.int32,
+    "times": np.int64,  # date_time in seconds since EPOCH, exact enough for the time windows
+}
+
+# Rows of the unique_id ranges database-feeding logged in tweet_changes for the data versions in
+# (%s, %s]: every row inserted or upserted since a snapshot's version, possibly with others
+CHANGED_ROWS_SQL = """
+SELECT {columns}
+FROM tweet_changes c JOIN tweets ON tweets.unique_id BETWEEN c.first_id AND c.last_id
+WHERE c.version > %s AND c.version <= %s
+"""
+
+_lock = threading.Lock()
+_mapped = None  # Snapshot this worker has mapped
+_building = False
+
+
+class Snapshot:
+
+    def __init__(self, name):
+        self.name = name
+        directory = os.path.join(SNAPSHOT_DIR, name)
+        with open(os.path.join(directory, "version")) as f:
+            self.version = int(f.read())
+        for column in COLUMNS:
+            setattr(self, column, np.load(os.path.join(directory, f"{column}.npy"), mmap_mode="r"))
+
+    def existing(self, ids):
+        # The ids that are tweets of the snapshot, in request order
+        ids = ids[(ids > 0) & (ids < len(self.present))]
+        return ids[self.present[ids]]
+
+
+def read_current():
+    try:
+        with open(os.path.join(SNAPSHOT_DIR, "CURRENT")) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def get_snapshot(version):
+    # The snapshot of data_version `version`, mapped on first use. None when there is none
+    # yet, a build is then started.
+    global _mapped
+    snapshot = None
+    for _ in range(MAP_ATTEMPTS):
+        name = read_current()
+        if name and not name.endswith(f"-{FORMAT}"):
+            name = None
+        try:
+            with _lock:
+                if name and (_mapped is None or _mapped.name != name):
+                    _mapped = Snapshot(name)
+                snapshot = _mapped
+            break
+        except FileNotFoundError:
+            # Builds since CURRENT was read deleted the snapshot it named, read the new one
+            continue
+    if snapshot is not None and snapshot.version == version:
+        return snapshot
+    start_build()
+    return None
+
+
+def start_build():
+    global _building
+    with _lock:
+        if _building:
+            return
+        _building = True
+    threading.Thread(target=build_in_background, name="snapshot-build", daemon=True).start()
+
+
+def build_in_background():
+    global _building
+    try:
+        build_snapshot()
+    except Exception as error:
+        print(error)
+    finally:
+        with _lock:
+            _building = False
+
+
+def build_snapshot():
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    with open(os.path.join(SNAPSHOT_DIR, ".lock"), "w") as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return  # Another worker is building it
+        start = time.monotonic()
+        with db_connection() as conn:
+            try:
+                name, version, rows, source = export_snapshot(conn)
+            finally:
+                conn.rollback()
+        if name is None:
+            return
+        # Point CURRENT at the new snapshot; workers still mapping an older one keep their
+        # mapping valid after its files are deleted
+        previous = read_current()
+        with open(os.path.join(SNAPSHOT_DIR, "CURRENT.tmp"), "w") as f:
+            f.write(name)
+        os.replace(os.path.join(SNAPSHOT_DIR, "CURRENT.tmp"), os.path.join(SNAPSHOT_DIR, "CURRENT"))
+        for entry in os.listdir(SNAPSHOT_DIR):
+            if entry.startswith("v") and entry not in (name, previous):
+                shutil.rmtree(os.path.join(SNAPSHOT_DIR, entry), ignore_errors=True)
+        print(f"Built snapshot of data version {version} from {source}, {rows} rows read in {time.monotonic() - start:.1f}s")
+
+
+def export_snapshot(conn):
+    # Write the snapshot of the current data version into a new directory, returning its name
+    # (None when CURRENT is already up to date), data version, number of rows read and where
+    # they came from. When database-feeding's tweet_changes still reaches back to the current
+    # snapshot's version, that snapshot is copied and only the rows logged since are read;
+    # otherwise the whole table is exported. One REPEATABLE READ transaction, so the version, the
+    # log, the id range and the rows all describe the same state of the table.
+    cursor = conn.cursor()
+    cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+    cursor.execute("SELECT version FROM data_version")
+    version = cursor.fetchone()[0]
+    name = f"v{version}-{FORMAT}"
+    current = read_current()
+    if current == name:
+        return None, version, 0, None
+    base = Snapshot(current) if current and current.endswith(f"-{FORMAT}") else None
+    cursor.execute("SELECT min(version) FROM tweet_changes")
+    oldest = cursor.fetchone()[0]
+    if base is not None and oldest is not None and oldest - 1 <= base.version < version:
+        cursor.execute("SELECT COALESCE(max(last_id), 0) FROM tweet_changes WHERE version > %s AND version <= %s",
+                       (base.version, version))
+        size = max(len(base.present), cursor.fetchone()[0] + 1)
+        source = f"v{base.version}"
+    else:
+        base = None
+        cursor.execute("SELECT COALESCE(max(unique_id), 0) FROM tweets")
+        size = cursor.fetchone()[0] + 1
+        source = "the table"
+    cursor.close()
+
+    building = tempfile.mkdtemp(prefix=".build-", dir=SNAPSHOT_DIR)
+    try:
+        arrays = {column: np.lib.format.open_memmap(os.path.join(building, f"{column}.npy"), mode="w+",
+                                                    dtype=dtype, shape=(size,))
+                  for column, dtype in COLUMNS.items()}
+        if base is not None:
+            for column, array in arrays.items():
+                array[:len(base.present)] = getattr(base, column)
+        rows = 0
+        with db_query("export_snapshot") as query:
+            cursor = conn.cursor(name="export_snapshot")
+            cursor.itersize = FETCH_ROWS
+            columns = ("unique_id, COALESCE(number_of_likes, 0), COALESCE(number_of_shares, 0), "
+                       f"COALESCE(extract(epoch FROM date_time)::bigint, {NO_TIME})")
+            if base is not None:
+                # Upserted rows are patched, the ranges of new ones filled in
+                cursor.execute(CHANGED_ROWS_SQL.format(columns=columns), (base.version, version))
+            else:
+                cursor.execute(f"SELECT {columns} FROM tweets")
+            while True:
+                batch = cursor.fetchmany(FETCH_ROWS)
+                if not batch:
+                    break
+                ids, likes, shares, times = (np.array(values) for values in zip(*batch))
+                arrays["present"][ids] = True
+                arrays["likes"][ids] = likes
+                arrays["shares"][ids] = shares
+                arrays["times"][ids] = times
+                rows += len(batch)
+            cursor.close()
+            query["rows"] = rows
+        for array in arrays.values():
+            array.flush()
+        del arrays
+        with open(os.path.join(building, "version"), "w") as f:
+            f.write(str(version))
+        shutil.rmtree(os.path.join(SNAPSHOT_DIR, name), ignore_errors=True)
+        os.rename(building, os.path.join(SNAPSHOT_DIR, name))
+    except BaseException:
+        shutil.rmtree(building, ignore_errors=True)
+        raise
+    return name, version, rows, source
+
+
+def decode_id_arrays(payload):
+    # idset.decode_id_sets straight into int64 arrays, without a Python int per id
+    return {key: np.cumsum(np.frombuffer(zlib.decompress(blob), dtype="<u4"), dtype=np.int64)
+            for key, blob in msgpack.unpackb(payload, raw=False).items()}
+
+
+def seconds(date_time):
+    return (date_time - EPOCH) // timedelta(seconds=1)
+
+
+def histogram(times, granularity):
+    # Vectorized build_histogram over seconds since EPOCH
+    days = times[times != NO_TIME] // 86400
+    if granularity == "week":
+        days = days - (days + 3) % 7  # 1970-01-01 was a Thursday, weeks start on Monday
+    dates = days.astype("datetime64[D]")
+    if granularity == "month":
+        dates = dates.astype("datetime64[M]").astype("datetime64[D]")
+    elif granularity == "year":
+        dates = dates.astype("datetime64[Y]").astype("datetime64[D]")
+    buckets, counts = np.unique(dates, return_counts=True)
+    return [[str(bucket), int(count)] for bucket, count in zip(np.datetime_as_string(buckets, unit="D"), counts)]
+
+
+def analyze(data, snapshot, granularity, window):
+    # The statistics of analyze_tweets_in_python through gathers on the snapshot columns. Ties
+    # go to the first id in request order, like max(). Like the SQL conditions, a window with
+    # any bound leaves out the tweets without a date.
+    since, until = window
+    low = NO_TIME + 1 if since is None else seconds(since)
+    high = np.iinfo(np.int64).max if until is None else seconds(until)
+    insights = {}
+    for token, ids in data.items():
+        ids = snapshot.existing(np.asarray(ids, dtype=np.int64))
+        if window != (None, None):
+            times = snapshot.times[ids]
+            ids = ids[(times >= low) & (times < high)]
+        if not len(ids):
+            continue
+        likes = snapshot.likes[ids]
+        shares = snapshot.shares[ids]
+        total_tweets = len(ids)
+        insights[token] = {
+            "total_number_of_tweets": total_tweets,
+            "tweet_with_highest_number_of_likes": int(ids[np.argmax(likes)]),
+            "average_number_of_likes": int(likes.sum(dtype=np.int64)) / total_tweets,
+            "tweet_with_highest_number_of_shares": int(ids[np.argmax(shares)]),
+            "average_number_of_shares": int(shares.sum(dtype=np.int64)) / total_tweets,
+            "tweet_histogram": histogram(snapshot.times[ids], granularity)
+        }
+    return insights
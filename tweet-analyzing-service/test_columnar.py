@@ -0,0 +1,24 @@
+import os
+
+import numpy as np
+
+import columnar
+
+
+def write_snapshot(directory, name, version):
+    os.makedirs(os.path.join(directory, name))
+    with open(os.path.join(directory, name, "version"), "w") as f:
+        f.write(str(version))
+    for column, dtype in columnar.COLUMNS.items():
+        np.save(os.path.join(directory, name, f"{column}.npy"), np.zeros(4, dtype=dtype))
+
+
+def test_snapshot_deleted_after_reading_current(tmp_path, monkeypatch):
+    # A build pointed CURRENT at v2 and deleted v1 between this worker reading CURRENT and mapping v1
+    write_snapshot(str(tmp_path), f"v2-{columnar.FORMAT}", 2)
+    names = iter([f"v1-{columnar.FORMAT}", f"v2-{columnar.FORMAT}"])
+    monkeypatch.setattr(columnar, "SNAPSHOT_DIR", str(tmp_path))
+    monkeypatch.setattr(columnar, "read_current", lambda: next(names))
+    monkeypatch.setattr(columnar, "_mapped", None)
+    snapshot = columnar.get_snapshot(2)
+    assert snapshot is not None and snapshot.version == 2
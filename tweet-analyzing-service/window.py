@@ -0,0 +1,38 @@
+from datetime import datetime, timezone
+
+# Requests can be limited to the tweets of a time window, [since, until), each bound an ISO date
+# or datetime and optional. tweets is partitioned by month on date_time, so conditions on the
+# window let Postgres skip every partition outside of it.
+
+
+def parse_window(values):
+    # (since, until) from the request's args or JSON body, None for a missing bound. date_time
+    # holds UTC without a zone, so bounds with one are converted. Raises ValueError for a
+    # malformed window.
+    bounds = []
+    for name in ("since", "until"):
+        value = values.get(name)
+        try:
+            bound = datetime.fromisoformat(value) if value else None
+        except (TypeError, ValueError):
+            raise ValueError(f"{name} must be an ISO date or datetime, got {value!r}")
+        if bound is not None and bound.tzinfo is not None:
+            bound = bound.astimezone(timezone.utc).replace(tzinfo=None)
+        bounds.append(bound)
+    since, until = bounds
+    if since is not None and until is not None and since >= until:
+        raise ValueError("since must be before until")
+    return since, until
+
+
+def window_conditions(window, column="date_time"):
+    # SQL " AND ..." conditions keeping `column` inside the window, and their parameters
+    since, until = window
+    conditions, params = "", []
+    if since is not None:
+        conditions += f" AND {column} >= %s"
+        params.append(since)
+    if until is not None:
+        conditions += f" AND {column} < %s"
+        params.append(until)
+    return conditions, params
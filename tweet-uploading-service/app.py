@@ -2,7 +2,12 @@ import os
 from flask import Flask, request, jsonify
 import tweepy
 
+import metrics
+import tracing
+
 app = Flask(__name__)
+metrics.init_app(app)
+tracing.init_app(app)
 
 
 api_key = os.getenv('TWITTER_API_KEY')
@@ -40,5 +45,5 @@ def hello():
 
 
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0', port=3020)
+    app.run(debug=os.getenv('FLASK_DEBUG') == '1', host='0.0.0.0', port=3020)
     
\ No newline at end of file